@@ -0,0 +1,167 @@
+"""
+Cache of the output of the external converters (antiword and pdftohtml).
+
+Converted output is stored in a 'converted' directory inside the cache that
+the source documents are kept in, under a hash of the source document's
+bytes, the converter's version and the arguments it was run with. A
+reparse of a document that has already been converted then doesn't need
+to run the converter at all, and any change to the tool or how it is run
+gives a new key rather than a stale result.
+
+Set CONVERSION_CACHE = False in the settings to always run the converters.
+"""
+
+import errno
+import hashlib
+import os
+import re
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+tool_versions = {}
+
+def tool_version(name):
+    """
+    Return the version of the named converter, as reported by the tool.
+
+    Neither tool has a flag to just print its version, but both mention it
+    when given '-v': pdftohtml as its version, and antiword in its usage
+    message.
+    """
+    if name not in tool_versions:
+        try:
+            process = subprocess.Popen(
+                [name, '-v'],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT)
+            output = process.communicate()[0]
+        except OSError:
+            output = ''
+        match = re.search(r'(?i)version:?\s*(\S+)', output)
+        tool_versions[name] = match.group(1) if match else output.strip()
+    return tool_versions[name]
+
+def enabled():
+    return getattr(settings, 'CONVERSION_CACHE', True)
+
+def conversion_key(args, data):
+    """
+    Return the cache key for converting data by running args (the
+    converter followed by its options, but not the input or output files).
+    """
+    key = hashlib.sha1()
+    key.update(tool_version(args[0]))
+    key.update('\0')
+    key.update('\0'.join(args))
+    key.update('\0')
+    key.update(data)
+    return key.hexdigest()
+
+def conversion_path(cache_dir, key):
+    return os.path.join(cache_dir, 'converted', key[:2], key)
+
+# mkstemp makes files readable only by their owner. Files moved into place
+# by move_into_place get the permissions they would have had if they'd been
+# opened normally instead. (The umask can only be read by setting it, so
+# that's done once, here, rather than in threads that might create files.)
+umask = os.umask(0)
+os.umask(umask)
+
+def temporary_file(path):
+    """
+    Create a temporary file in the directory path will be in, making the
+    directory if need be, and return its (fd, path) as mkstemp does.
+    """
+    directory = os.path.dirname(path)
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        # Another thread or process may have just made it.
+        if e.errno != errno.EEXIST:
+            raise
+
+    return tempfile.mkstemp(dir=directory, prefix='.tmp-')
+
+def move_into_place(temp_path, path):
+    """Rename a file from temporary_file to path, readable as usual"""
+    os.chmod(temp_path, 0666 & ~umask)
+    os.rename(temp_path, path)
+
+def write_atomically(path, data):
+    """
+    Write data to path, via a temporary file in the same directory so that
+    a partly written file is never seen at path.
+    """
+    (fd, temp_path) = temporary_file(path)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        move_into_place(temp_path, path)
+    except:
+        os.remove(temp_path)
+        raise
+
+def cached_output(cache_dir, args, data, convert):
+    """
+    Return the output of converting data by running args, from the cache
+    in cache_dir if it's there.
+
+    Otherwise call convert() to do the conversion and store its output.
+    convert should raise an exception if the conversion fails, so that
+    failures aren't cached.
+    """
+    if not enabled():
+        return convert()
+
+    path = conversion_path(cache_dir, conversion_key(args, data))
+
+    if os.path.exists(path):
+        with open(path, 'rb') as cached:
+            return cached.read()
+
+    output = convert()
+    # An empty conversion is most likely a failure that the converter
+    # didn't report, so try again next time.
+    if output:
+        write_atomically(path, output)
+    return output
+
+def cached_lines(cache_dir, args, data, convert_lines):
+    """
+    Generate the lines of output from converting data by running args,
+    from the cache in cache_dir if it's there.
+
+    Otherwise the lines come from convert_lines(), which should return an
+    iterator over the converter's output as it is produced, and raise an
+    exception once the output is exhausted if the conversion failed. They
+    are copied into the cache as they go past, and the copy is only kept if
+    all the output was read and the conversion succeeded.
+    """
+    if not enabled():
+        for line in convert_lines():
+            yield line
+        return
+
+    path = conversion_path(cache_dir, conversion_key(args, data))
+
+    if os.path.exists(path):
+        with open(path, 'rb') as cached:
+            for line in cached:
+                yield line
+        return
+
+    (fd, temp_path) = temporary_file(path)
+    try:
+        with os.fdopen(fd, 'wb') as temp_file:
+            for line in convert_lines():
+                temp_file.write(line)
+                yield line
+
+        # As with cached_output, don't keep empty output.
+        if os.path.getsize(temp_path):
+            move_into_place(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
@@ -1,4 +1,6 @@
 import json
+import threading
+import time
 from datetime import date
 
 class DateEncoder (json.JSONEncoder):
@@ -8,3 +10,59 @@ class DateEncoder (json.JSONEncoder):
             return obj.strftime('%Y-%m-%d')
 
         return json.JSONEncoder.default(self, obj)
+
+class JsonLinesWriter(object):
+    """
+    Write objects to a file as JSON Lines (one JSON document to a line) as
+    they are produced, so nothing needs to be held in memory and a crashed
+    run leaves everything written so far.
+
+    The file is flushed every flush_every objects, and at least every
+    flush_interval seconds while objects are being written. Writing is
+    safe from several threads.
+    """
+
+    def __init__(self, filename, flush_every=100, flush_interval=5, cls=DateEncoder):
+        self.file = open(filename, 'w')
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.cls = cls
+        self.lock = threading.Lock()
+        self.unflushed = 0
+        self.flushed_at = time.time()
+
+    def write(self, obj):
+        line = json.dumps(obj, cls=self.cls) + '\n'
+        with self.lock:
+            self.file.write(line)
+            self.unflushed += 1
+            if (self.unflushed >= self.flush_every or
+                time.time() - self.flushed_at >= self.flush_interval):
+                self.file.flush()
+                self.unflushed = 0
+                self.flushed_at = time.time()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_json_lines(filename):
+    """
+    Generate the objects in a JSON Lines file one at a time. A partly
+    written last line, left by a run that crashed, is ignored.
+    """
+    with open(filename) as infile:
+        for line in infile:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                if line.endswith('\n'):
+                    raise
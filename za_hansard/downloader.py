@@ -0,0 +1,112 @@
+"""
+Concurrent downloading of Hansard sources into the cache.
+
+Source.file() fetches one source at a time. prefetch_sources() fetches many
+at once from a small pool of threads, sharing a Fetcher's pool of
+connections. Only the calling thread touches the database.
+"""
+
+import os
+
+from multiprocessing.pool import ThreadPool
+
+from za_hansard.conversion_cache import write_atomically
+from za_hansard.fetch import Fetcher, FetchError
+
+class SourceDownloader(object):
+    """
+    Fetch sources' documents into their cache files.
+
+    The fetcher (by default a new za_hansard.fetch.Fetcher) takes care of
+    retries and spacing out the requests. A 404 isn't retried, but as in
+    Source.file() the url is tried again with '.doc' on the end.
+    """
+
+    def __init__(self, workers=4, fetcher=None):
+        self.workers = workers
+        self.fetcher = fetcher or Fetcher(pool_size=workers)
+
+    def request(self, url):
+        """Return the status and content (or error message) for url"""
+        try:
+            response = self.fetcher.get(url)
+        except FetchError as e:
+            return (e.status, str(e))
+        return (response.status_code, response.content)
+
+    def download(self, job):
+        """
+        Download a source's document to path.
+
+        job is a tuple of the source's id, its download url and its cache
+        file path. Returns a tuple of the id, the suffix that had to be
+        added to the url (or None if it couldn't be downloaded) and the
+        status and error of the failure.
+        """
+        (source_id, url, path) = job
+
+        (status, content) = self.request(url)
+        suffix = ''
+        if status == 404 and not url.endswith('.doc'):
+            suffix = '.doc'
+            (status, content) = self.request(url + suffix)
+
+        if status != 200:
+            return (source_id, None, status, content)
+        if not content:
+            return (source_id, None, status, 'no content, url: %s' % url)
+
+        write_atomically(path, content)
+        return (source_id, suffix, status, None)
+
+    def download_all(self, jobs):
+        """
+        Download each of jobs (see download), generating the results as
+        they complete.
+        """
+        pool = ThreadPool(self.workers)
+        try:
+            for result in pool.imap_unordered(self.download, jobs):
+                yield result
+        finally:
+            pool.terminate()
+            pool.join()
+
+def prefetch_sources(sources, downloader=None, log=None):
+    """
+    Download the documents for any of sources that aren't already in the
+    cache, updating each source as Source.file() would. The source objects
+    themselves are changed and saved, so that a caller who saves them
+    again later doesn't put back their old url or is404.
+
+    Returns a tuple of the number of sources downloaded and the number that
+    failed. log, if given, is called with a message about each failure.
+    """
+    downloader = downloader or SourceDownloader()
+
+    jobs = []
+    by_id = {}
+    for s in sources:
+        path = s.cache_file_path()
+        if not os.path.isfile(path):
+            jobs.append((s.id, s.download_url(), path))
+            by_id[s.id] = s
+
+    downloaded = failed = 0
+    for (source_id, suffix, status, error) in downloader.download_all(jobs):
+        s = by_id[source_id]
+        if suffix is None:
+            failed += 1
+            if status == 404:
+                s.is404 = True
+                s.save()
+            if log:
+                log('Failed to download source %d: %s' % (source_id, error))
+            continue
+
+        downloaded += 1
+        s.url += suffix
+        s.is404 = False
+        s.save()
+
+    return (downloaded, failed)
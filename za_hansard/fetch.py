@@ -0,0 +1,295 @@
+"""
+Fetching over HTTP, for all of the scrapers.
+
+A Fetcher keeps a pool of connections open to each host (through a
+requests.Session) and retries network errors and server errors with
+exponential backoff. Its requests are scheduled by a HostScheduler, shared
+by every Fetcher in the process, which lets through one request every
+FETCH_MIN_INTERVAL seconds (0.5 by default) to each host, in bursts of up
+to FETCH_BURST (1), with at most FETCH_HOST_CONCURRENCY (4) at a time, and
+slows down for a host that starts answering with 429s or 5xxs.
+
+Pages that are checked again and again for new entries (the listings) can
+be fetched with conditional=True. The ETag and Last-Modified validators,
+Content-Type and body of the last response for each url are then kept in
+FETCH_CACHE (by default a 'fetched' directory in HANSARD_CACHE), and the
+validators sent with the next request for it, so that an unchanged page
+comes back as a body-less 304.
+
+Most code can just use get(), which uses a Fetcher shared by the whole
+process. Anything that needs its own cookies (logging into PMG) should make
+its own Fetcher.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+import urlparse
+
+import requests
+import requests.adapters
+import requests.utils
+
+from django.conf import settings
+
+from za_hansard.conversion_cache import write_atomically
+
+class FetchError(Exception):
+    """
+    A url couldn't be fetched. status is the HTTP status of the last
+    response, or None if there wasn't one.
+    """
+    def __init__(self, message, status=None):
+        super(FetchError, self).__init__(message)
+        self.status = status
+
+class HostState(object):
+    """The token bucket and concurrency limit for one host"""
+
+    def __init__(self, interval, burst, concurrency):
+        self.interval = interval
+        self.tokens = burst
+        self.updated = time.time()
+        self.blocked_until = 0
+        self.slots = threading.Semaphore(concurrency)
+
+class HostScheduler(object):
+    """
+    Schedule requests politely, host by host.
+
+    Each host has a token bucket that fills at one token every interval
+    seconds, up to burst tokens, and at most concurrency requests to it are
+    made at once. A 429 or 5xx response doubles the host's interval (up to
+    max_interval) and each success brings it back down towards the
+    configured one; a Retry-After header holds off all requests to the host
+    for that long.
+    """
+
+    # The interval after a first 429 or 5xx, if doubling gives less.
+    min_slow_interval = 1
+    max_interval = 60
+
+    def __init__(self, interval, burst=1, concurrency=4):
+        self.interval = interval
+        self.burst = burst
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def host(self, url):
+        host = urlparse.urlparse(url).netloc
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = HostState(self.interval, self.burst, self.concurrency)
+            return self.hosts[host]
+
+    def acquire(self, url):
+        """Wait until a request to url may be made"""
+        state = self.host(url)
+        state.slots.acquire()
+
+        with self.lock:
+            now = time.time()
+            if state.interval:
+                state.tokens = min(
+                    self.burst,
+                    state.tokens + (now - state.updated) / state.interval)
+            state.updated = now
+            # Take a token even if there isn't one yet, and wait for it;
+            # later requests queue up behind this one.
+            state.tokens -= 1
+            start = max(now + max(-state.tokens, 0) * state.interval, state.blocked_until)
+
+        if start > now:
+            time.sleep(start - now)
+
+    def release(self, url, status=None, retry_after=None):
+        """
+        Record that a request to url has finished with status (None if
+        there was no response).
+        """
+        state = self.host(url)
+        with self.lock:
+            if status == 429 or (status is not None and status >= 500):
+                state.interval = min(
+                    self.max_interval, max(state.interval * 2, self.min_slow_interval))
+            elif status is not None:
+                state.interval = max(self.interval, state.interval * 0.75)
+            if retry_after:
+                state.blocked_until = max(state.blocked_until, time.time() + retry_after)
+        state.slots.release()
+
+class ValidatorStore(object):
+    """
+    The validators (ETag and Last-Modified), Content-Type and body of the
+    last response for each url, in files named by a hash of the url.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def paths(self, url):
+        key = hashlib.sha1(url).hexdigest()
+        path = os.path.join(self.directory, key[:2], key)
+        return (path + '.json', path)
+
+    def get(self, url):
+        """Return the validators and body stored for url, or None"""
+        (validators_path, body_path) = self.paths(url)
+        try:
+            with open(validators_path) as validators_file:
+                validators = json.load(validators_file)
+            with open(body_path, 'rb') as body_file:
+                return (validators, body_file.read())
+        except (IOError, ValueError):
+            return None
+
+    def put(self, url, validators, body):
+        (validators_path, body_path) = self.paths(url)
+        # Write the body first, so the validators never refer to a body
+        # that isn't there.
+        write_atomically(body_path, body)
+        write_atomically(validators_path, json.dumps(validators))
+
+class Fetcher(object):
+
+    def __init__(self, retries=3, backoff=1.0, interval=None, timeout=60,
+                 pool_size=10, validator_dir=None, scheduler=None):
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+        # Fetchers share one scheduler, so that all the requests the process
+        # makes to a host count against the same limits, unless they're
+        # given their own scheduler or interval.
+        if scheduler is None:
+            if interval is None:
+                scheduler = default_scheduler()
+            else:
+                scheduler = HostScheduler(interval)
+        self.scheduler = scheduler
+
+        if validator_dir is None:
+            validator_dir = getattr(
+                settings, 'FETCH_CACHE',
+                os.path.join(settings.HANSARD_CACHE, 'fetched'))
+        self.validators = ValidatorStore(validator_dir)
+
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, conditional=False, **kwargs):
+        """
+        Return the response for url, which will have a status of 200.
+
+        If conditional is set, a stored copy of the page is reused if the
+        server says it hasn't changed. Raises FetchError if the url can't be
+        fetched, or doesn't give a 200 response.
+        """
+        if not conditional:
+            return self.request('GET', url, **kwargs)
+
+        stored = self.validators.get(url)
+        headers = dict(kwargs.pop('headers', {}))
+        if stored:
+            (validators, body) = stored
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        response = self.request('GET', url, headers=headers, allowed=(200, 304) if stored else (200,), **kwargs)
+
+        if response.status_code == 304:
+            response.status_code = 200
+            response._content = body
+            # A 304 doesn't usually repeat the Content-Type, which .text
+            # needs to decode the body the same way as the original.
+            if validators.get('content_type'):
+                response.headers['Content-Type'] = validators['content_type']
+                response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+            return response
+
+        validators = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'content_type': response.headers.get('Content-Type'),
+            }
+        if validators['etag'] or validators['last_modified']:
+            self.validators.put(url, validators, response.content)
+        return response
+
+    def post(self, url, data, **kwargs):
+        return self.request('POST', url, data=data, **kwargs)
+
+    def request(self, method, url, allowed=(200,), **kwargs):
+        """
+        Make a request, retrying network errors and 5xx responses, and
+        return the response if its status is in allowed.
+        """
+        kwargs.setdefault('timeout', self.timeout)
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+
+            self.scheduler.acquire(url)
+            response = None
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except requests.RequestException as e:
+                error = FetchError('%s fetching %s' % (e, url))
+                continue
+            finally:
+                if response is None:
+                    self.scheduler.release(url)
+                else:
+                    self.scheduler.release(
+                        url, response.status_code, retry_after(response))
+
+            if response.status_code in allowed:
+                return response
+
+            error = FetchError(
+                'status code: %s, url: %s' % (response.status_code, url),
+                status=response.status_code)
+            if response.status_code < 500 and response.status_code != 429:
+                break
+
+        raise error
+
+def retry_after(response):
+    """Return the seconds a response's Retry-After header asks for, or None"""
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        # Missing, or an HTTP date, which isn't worth parsing here.
+        return None
+
+defaults = {}
+defaults_lock = threading.Lock()
+
+def default_scheduler():
+    """The HostScheduler shared by the process's Fetchers"""
+    with defaults_lock:
+        if 'scheduler' not in defaults:
+            defaults['scheduler'] = HostScheduler(
+                getattr(settings, 'FETCH_MIN_INTERVAL', 0.5),
+                burst=getattr(settings, 'FETCH_BURST', 1),
+                concurrency=getattr(settings, 'FETCH_HOST_CONCURRENCY', 4))
+        return defaults['scheduler']
+
+def get(url, **kwargs):
+    """Fetch url with the process's shared Fetcher (see Fetcher.get)"""
+    # default_scheduler() takes the lock too, so get the scheduler first.
+    scheduler = default_scheduler()
+    with defaults_lock:
+        if 'fetcher' not in defaults:
+            defaults['fetcher'] = Fetcher(scheduler=scheduler)
+        fetcher = defaults['fetcher']
+    return fetcher.get(url, **kwargs)
@@ -0,0 +1,248 @@
+import datetime
+import glob
+import json
+import os
+import resource
+import sys
+import time
+
+from contextlib import contextmanager
+from cStringIO import StringIO
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.test.utils import override_settings
+
+from za_hansard import conversion_cache, question_scraper
+from za_hansard.parse import ZAHansardParser
+
+test_inputs_dir = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+    'tests', 'test_inputs')
+
+@contextmanager
+def quiet():
+    """Throw away anything the code being timed writes to stdout"""
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def peak_memory():
+    """
+    Return the peak resident set size, in kilobytes, of this process and of
+    the largest subprocess (antiword/pdftohtml) it has waited for.
+
+    These are high-water marks for the whole run, so a stage's figures
+    include every stage before it.
+    """
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+        )
+
+class Command(BaseCommand):
+    help = 'Time the Hansard, question paper and answer parsing stages'
+    option_list = BaseCommand.option_list + (
+        make_option('--scale',
+            default=10,
+            type='int',
+            help='Size of the synthetic documents, as a multiple of the fixtures (default 10, 0 to skip)',
+        ),
+        make_option('--output',
+            type='str',
+            help='Write the results as JSON to this file',
+        ),
+        make_option('--compare',
+            type='str',
+            help='Compare the results with a JSON file from an earlier run',
+        ),
+        make_option('--use-conversion-cache',
+            default=False,
+            action='store_true',
+            help='Use cached antiword/pdftohtml output instead of timing the converters',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        scale = options['scale']
+        self.results = {}
+
+        with override_settings(CONVERSION_CACHE=options['use_conversion_cache']):
+            self.benchmark_hansards(scale)
+            self.benchmark_question_papers(scale)
+            self.benchmark_answers(scale)
+
+        for name in sorted(self.results):
+            stage = self.results[name]
+            self.stdout.write(
+                '%-32s %3d docs %8.3fs %8.2f docs/s %8.2f MB/s peak %dkB (subprocess %dkB)\n' % (
+                    name,
+                    stage['documents'],
+                    stage['seconds'],
+                    stage['documents_per_second'],
+                    stage['mb_per_second'],
+                    stage['peak_rss_kb'],
+                    stage['peak_subprocess_rss_kb'],
+                    ))
+
+        if options['compare']:
+            self.compare(options['compare'])
+
+        if options['output']:
+            with open(options['output'], 'w') as outfile:
+                json.dump({
+                        'date': datetime.datetime.now().isoformat(),
+                        'scale': scale,
+                        'stages': self.results,
+                        },
+                    outfile, indent=1, sort_keys=True)
+            self.stdout.write('Wrote %s\n' % options['output'])
+
+    def time_stage(self, name, documents, run, from_files=False):
+        """
+        Call run on each of documents (pairs of a label and the input to
+        run), recording the total time taken and the bytes processed.
+
+        If from_files is set the inputs are filenames, and their sizes are
+        taken from the files rather than from the inputs themselves.
+        """
+        documents = list(documents)
+        total_bytes = 0
+        outputs = []
+
+        start = time.time()
+        for label, document in documents:
+            total_bytes += os.path.getsize(document) if from_files else len(document)
+            with quiet():
+                outputs.append(run(document))
+        seconds = time.time() - start
+
+        (peak_rss, peak_subprocess_rss) = peak_memory()
+
+        self.results[name] = {
+            'documents': len(documents),
+            'bytes': total_bytes,
+            'seconds': seconds,
+            'documents_per_second': len(documents) / seconds if seconds else 0,
+            'mb_per_second': total_bytes / 1048576.0 / seconds if seconds else 0,
+            'peak_rss_kb': peak_rss,
+            'peak_subprocess_rss_kb': peak_subprocess_rss,
+            }
+        return zip([label for label, _ in documents], outputs)
+
+    def benchmark_hansards(self, scale):
+        docs = sorted(glob.glob(os.path.join(test_inputs_dir, 'hansard', '*.doc')))
+
+        converted = self.time_stage(
+            'hansard.antiword',
+            [(doc, doc) for doc in docs],
+            lambda doc: ''.join(ZAHansardParser.antiword_lines(doc)),
+            from_files=True)
+
+        self.time_stage(
+            'hansard.parse',
+            converted,
+            lambda text: ZAHansardParser.parse_lines(StringIO(text)))
+
+        if scale:
+            self.time_stage(
+                'hansard.parse.synthetic',
+                [(label, self.scale_hansard(text, scale)) for label, text in converted],
+                lambda text: ZAHansardParser.parse_lines(StringIO(text)))
+
+    def scale_hansard(self, text, scale):
+        # Keep the first line, which has the date of the sitting, and
+        # repeat the proceedings after it.
+        (date, proceedings) = text.split('\n', 1)
+        return '\n'.join([date] + [proceedings] * scale)
+
+    def benchmark_question_papers(self, scale):
+        pdfs = sorted(glob.glob(os.path.join(test_inputs_dir, 'questions', '*.pdf')))
+
+        converted = self.time_stage(
+            'questions.pdftohtml',
+            [(pdf, open(pdf).read()) for pdf in pdfs],
+            question_scraper.pdftoxml)
+
+        self.time_stage(
+            'questions.parse',
+            converted,
+            self.create_questions)
+
+        if scale:
+            self.time_stage(
+                'questions.parse.synthetic',
+                [(label, self.scale_question_paper(xml, scale)) for label, xml in converted],
+                self.create_questions)
+
+    def scale_question_paper(self, xmldata, scale):
+        # Repeat every page after the first, which has the paper's details.
+        (head, first_page_end, pages) = xmldata.partition('</page>')
+        (pages, end_tag, tail) = pages.rpartition('</pdf2xml>')
+        return ''.join([head, first_page_end, pages * scale, end_tag, tail])
+
+    def create_questions(self, xmldata):
+        # Run the parse against the database, but don't keep anything.
+        with transaction.commit_manually():
+            try:
+                url = 'http://benchmark.invalid/%d.pdf' % id(xmldata)
+                parser = question_scraper.QuestionPaperParser(
+                    name='BENCHMARK',
+                    date='1 January 2013',
+                    house='National Assembly',
+                    language='English',
+                    url=url,
+                    document_number=0,
+                    )
+                parser.create_questions_from_xml(xmldata, url)
+            finally:
+                transaction.rollback()
+
+    def benchmark_answers(self, scale):
+        docs = sorted(glob.glob(os.path.join(test_inputs_dir, 'questions', '*.doc')))
+
+        converted = self.time_stage(
+            'answers.antiword',
+            [(doc, doc) for doc in docs],
+            self.convert_answer,
+            from_files=True)
+
+        self.time_stage(
+            'answers.parse',
+            converted,
+            question_scraper.answer_text_from_antiword_output)
+
+        if scale:
+            self.time_stage(
+                'answers.parse.synthetic',
+                [(label, output * scale) for label, output in converted],
+                question_scraper.answer_text_from_antiword_output)
+
+    def convert_answer(self, filename):
+        with open(filename, 'rb') as document:
+            data = document.read()
+
+        return conversion_cache.cached_output(
+            settings.ANSWER_CACHE, ['antiword'], data,
+            lambda: question_scraper.check_output_wrapper(['antiword', filename]))
+
+    def compare(self, filename):
+        try:
+            with open(filename) as infile:
+                previous = json.load(infile)['stages']
+        except (IOError, ValueError, KeyError) as e:
+            raise CommandError("Could not read results from %s: %s" % (filename, e))
+
+        self.stdout.write('\nCompared with %s:\n' % filename)
+        for name in sorted(self.results):
+            if name not in previous or not previous[name]['seconds']:
+                continue
+            change = self.results[name]['seconds'] / previous[name]['seconds'] - 1
+            self.stdout.write('%-32s %+7.1f%%%s\n' % (
+                name, change * 100, '  SLOWER' if change > 0.1 else ''))
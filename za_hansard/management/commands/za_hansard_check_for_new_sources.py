@@ -1,10 +1,12 @@
 import pprint
-import httplib2
 import re
 import datetime
 import time
 import sys
+import collections
+import itertools
 
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 from bs4 import BeautifulSoup
 
@@ -12,7 +14,9 @@ from django.conf import settings
 
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
 
+from za_hansard import fetch
 from za_hansard.models import Source
 
 class FailedToRetrieveSourceException (Exception):
@@ -41,102 +45,171 @@ class Command(BaseCommand):
             type='str',
             help='Limit earliest historical entry to check (in yyyy-mm-dd format, default 2009-04-22)',
         ),
+        make_option('--batch-size',
+            default=500,
+            type='int',
+            help='Number of new sources to insert at once (default 500)',
+        ),
+        make_option('--workers',
+            default=4,
+            type='int',
+            help='Number of listing pages to fetch at once (default 4)',
+        ),
     )
 
     def handle(self, *args, **options):
 
         self.historical_limit = datetime.datetime.strptime(options['historical_limit'], '%Y-%m-%d').date()
 
+        # The (document_name, document_number) of every source we already
+        # have, so that scraped documents can be checked without a query each.
+        self.known_sources = set(
+            Source.objects.values_list('document_name', 'document_number'))
+
         sources = self.retrieve_sources(options['start_offset'], options)
         sources.reverse()
-        sources_db = [Source.objects.get_or_create(**source) for source in sources]
+        created_count = self.create_sources(sources, options['batch_size'])
         sources_count = len(sources)
-        created_count = sum([1 for (_,created) in sources_db if created])
         self.stdout.write('Sources found: %d\nSources created: %d\n' % (
             sources_count, created_count))
 
-    def retrieve_sources(self, start, options):
+    def create_sources(self, sources, batch_size):
+        """
+        Insert the scraped sources that we don't already have, in batches,
+        and return the number inserted.
+        """
+        known_numbers = set(number for (_, number) in self.known_sources)
+
+        new_sources = []
+        for source in sources:
+            key = self.source_key(source)
+            if key in self.known_sources:
+                continue
+            if key[1] in known_numbers:
+                self.stderr.write('WARN: Skipping %s, document number %d already exists with another name\n' % key)
+                continue
+            self.known_sources.add(key)
+            known_numbers.add(key[1])
+
+            fields = dict(source['defaults'])
+            fields['document_name'] = source['document_name']
+            fields['document_number'] = source['document_number']
+            new_sources.append(Source(**fields))
+
+        with transaction.commit_on_success():
+            for i in range(0, len(new_sources), batch_size):
+                Source.objects.bulk_create(new_sources[i:i + batch_size])
+
+        return len(new_sources)
+
+    def source_key(self, source):
+        return (source['document_name'], int(source['document_number']))
 
+    def retrieve_sources(self, start, options):
+        """
+        Scrape the listing pages from start, returning the new sources found.
+
+        The first page gives the total number of documents, so the offsets
+        of the rest are known and they are fetched several at a time. They
+        are still checked in order, and once a seen document (unless
+        --check-all) or the historical limit is reached no more pages are
+        requested.
+        """
+        scraped = []
+        pool = ThreadPool(options['workers'])
         try:
-            url = 'http://www.parliament.gov.za/live/content.php?Category_ID=119&DocumentStart=%d' % (start or 0)
-            self.stdout.write("Retrieving %s\n" % url)
-            h = httplib2.Http( settings.HTTPLIB2_CACHE_DIR )
-            response, content = h.request(url)
-            assert response.status == 200
-            self.stdout.write("OK\n")
-            # content = open('test.html').read()
-
-            # parse content
-            soup = BeautifulSoup(
-                content,
-                'xml',
-            )
-
-            rx = re.compile(r'Displaying (\d+)  (\d+) of the most recent (\d+)')
-
-            pager = soup.find('td', text=rx)
-            match = rx.search(pager.text)
-            (pstart, pend, ptotal) = [int(p) for p in match.groups()]
-
-            self.stdout.write( "Processing %d to %d\n" % (pstart, pend) )
-
-            nodes = soup.findAll( 'a', text="View Document" )
-            def scrape(node):
-                url = node['href']
-                table = node.find_parent('table')
-                rx = re.compile(r'>([^:<]*) : ([^<]*)<')
-
-                data = {}
-                for match in re.finditer(rx, str(table)):
-                    groups = match.groups()
-                    data[groups[0]] = groups[1]
-
-                title = ''
-                try:
-                    data['Title'] = table.find('b').text
-                except:
-                    data['Title'] = data.get('Document Summary', '(unknown)')
-
-                try:
-                    document_date = datetime.datetime.strptime(data['Date Published'], '%d %B %Y').date()
-                except Exception as e:
-                    raise CommandError( "Date could not be parsed\n%s" % str(e) )
-                    # document_date = datetime.date.today()
-
-                #(obj, created) = Source.objects.get_or_create(
-                return {
-                    'document_name':   data['Document Name'],
-                    'document_number': data['Document Number'],
-                    'defaults': {
-                        'url':      url,
-                        'title':    data['Title'],
-                        'language': data.get('Language', 'English'),
-                        'house':    data.get('House', '(unknown)'),
-                        'date':     document_date,
-                    }
-                }
-            scraped = []
-            for node in nodes:
-                s = scrape(node)
-                if Source.objects.filter(
-                    document_name   = s['document_name'],
-                    document_number = s['document_number']).exists():
-                    if not options['check_all']:
-                        print "Reached seen document. Stopping.\n"
+            (pstart, pend, ptotal, page) = self.retrieve_page(start)
+            last = options['limit'] or ptotal
+            page_size = pend - pstart + 1
+            offsets = iter(range(pend, last, page_size))
+
+            # Pages requested but not yet checked, in order.
+            pending = collections.deque()
+            while True:
+                for s in page:
+                    if self.source_key(s) in self.known_sources:
+                        if not options['check_all']:
+                            print "Reached seen document. Stopping.\n"
+                            return scraped
+                    if s['defaults']['date'] < self.historical_limit:
+                        print "Reached historical limit. Stopping.\n"
                         return scraped
-                if s['defaults']['date'] < self.historical_limit:
-                    print "Reached historical limit. Stopping.\n"
-                    return scraped
 
-                # otherwise
-                scraped.append(s)
+                    # otherwise
+                    scraped.append(s)
 
-            if pend < (options['limit'] or ptotal):
-                # NB following isn't phrased as a tail call, could rewrite if
-                # that becomes important
-                scraped = scraped + self.retrieve_sources(pend, options)
-            return scraped
+                for offset in itertools.islice(offsets, options['workers'] - len(pending)):
+                    pending.append(pool.apply_async(self.retrieve_page, (offset,)))
+                if not pending:
+                    return scraped
+                (pstart, pend, ptotal, page) = pending.popleft().get()
 
         except Exception as e:
             print >> sys.stderr, "ERROR: %s" % str(e)
-            return []
+            return scraped
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def retrieve_page(self, start):
+        """
+        Fetch and scrape the listing page starting at start, returning its
+        position in the listing and the sources on it.
+        """
+        url = 'http://www.parliament.gov.za/live/content.php?Category_ID=119&DocumentStart=%d' % (start or 0)
+        self.stdout.write("Retrieving %s\n" % url)
+        content = fetch.get(url, conditional=True).content
+        self.stdout.write("OK\n")
+        # content = open('test.html').read()
+
+        # parse content
+        soup = BeautifulSoup(
+            content,
+            'xml',
+        )
+
+        rx = re.compile(r'Displaying (\d+)  (\d+) of the most recent (\d+)')
+
+        pager = soup.find('td', text=rx)
+        match = rx.search(pager.text)
+        (pstart, pend, ptotal) = [int(p) for p in match.groups()]
+
+        self.stdout.write( "Processing %d to %d\n" % (pstart, pend) )
+
+        nodes = soup.findAll( 'a', text="View Document" )
+        return (pstart, pend, ptotal, [self.scrape(node) for node in nodes])
+
+    def scrape(self, node):
+        url = node['href']
+        table = node.find_parent('table')
+        rx = re.compile(r'>([^:<]*) : ([^<]*)<')
+
+        data = {}
+        for match in re.finditer(rx, str(table)):
+            groups = match.groups()
+            data[groups[0]] = groups[1]
+
+        title = ''
+        try:
+            data['Title'] = table.find('b').text
+        except:
+            data['Title'] = data.get('Document Summary', '(unknown)')
+
+        try:
+            document_date = datetime.datetime.strptime(data['Date Published'], '%d %B %Y').date()
+        except Exception as e:
+            raise CommandError( "Date could not be parsed\n%s" % str(e) )
+            # document_date = datetime.date.today()
+
+        #(obj, created) = Source.objects.get_or_create(
+        return {
+            'document_name':   data['Document Name'],
+            'document_number': data['Document Number'],
+            'defaults': {
+                'url':      url,
+                'title':    data['Title'],
+                'language': data.get('Language', 'English'),
+                'house':    data.get('House', '(unknown)'),
+                'date':     document_date,
+            }
+        }
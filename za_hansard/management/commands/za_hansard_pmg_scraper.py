@@ -1,32 +1,114 @@
 import parslepy
-import urllib2
+import parslepy.funcs
 import httplib
 import re
 import pprint
 import csv
 import json
-from za_hansard.datejson import DateEncoder
-from bs4 import BeautifulSoup
+import hashlib
+import itertools
+from za_hansard.conversion_cache import write_atomically
+from za_hansard.datejson import DateEncoder, JsonLinesWriter
+from za_hansard.fetch import Fetcher, FetchError
+from lxml.cssselect import CSSSelector
 import sys, os
 import time
-import cookielib
-import urllib
+import threading
+import lxml.etree
 
+from contextlib import closing
 from datetime import datetime, date
 
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.conf import settings
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 from instances.models import Instance
 from za_hansard.models import PMGCommitteeReport, PMGCommitteeAppearance
+from za_hansard.pools import process_pool
+from za_hansard.sayit_import import import_documents
 from speeches.importers.import_json import ImportJson
 
 class StopFetchingException (Exception):
     # this is a control flow exception.
     pass
 
+report_selectors = {
+    'heading': CSSSelector('h1.title'),
+    'chairperson': CSSSelector('div.field-field-chairperson'),
+    'paragraphs': CSSSelector('.field-field-minutes p.MsoNormal'),
+    'minutes': CSSSelector('div.field-field-minutes'),
+    }
+
+def extract_report(contents):
+    """
+    Extract a committee report page's heading and chairperson (if it has
+    them), its minutes' p.MsoNormal paragraphs, and the lines of its
+    minutes, all from one parse of the page.
+
+    The minutes are split on the newlines in their text, as their
+    paragraphs are often just separated by <br/>s.
+
+    >>> report = extract_report('''<h1 class="title">Meeting</h1>
+    ... <div class="field-field-minutes"><div><b><i>Discussion</i></b>
+    ... Mr A Smith (ANC) asked about R&amp;D.<br/> Ms C Jones (DA) replied.
+    ... <p class="MsoNormal">The Chairperson agreed.</p></div></div>''')
+    >>> sorted(report.keys())
+    ['heading', 'minutes', 'paragraphs']
+    >>> report['minutes']
+    [u'', u'Mr A Smith (ANC) asked about R&D. Ms C Jones (DA) replied.', u'The Chairperson agreed.']
+    >>> report['paragraphs']
+    [u'The Chairperson agreed.']
+    """
+    root = lxml.etree.fromstring(contents, lxml.etree.HTMLParser())
+
+    report = {}
+    for key in ('heading', 'chairperson'):
+        found = report_selectors[key](root)
+        if found:
+            report[key] = parslepy.funcs.extract_text(found[0])
+
+    report['paragraphs'] = [
+        parslepy.funcs.extract_text(p) for p in report_selectors['paragraphs'](root)]
+
+    minutes = report_selectors['minutes'](root)
+    if minutes:
+        text = u''.join(minutes_text(minutes[0])).replace('\t', '')
+        report['minutes'] = text.split('\n')
+    else:
+        report['minutes'] = []
+
+    return report
+
+def encode_json(job):
+    """
+    Encode a report's JSON for save_json, for running in a process pool.
+    job is a tuple of the file it's for and the report's data.
+    """
+    (filename, data) = job
+    return (filename, json.dumps(data, indent=1, cls=DateEncoder))
+
+def minutes_text(element):
+    """
+    Generate the pieces of text in element, leaving out comments and the
+    bold italic "Discussion" headings.
+    """
+    if (element.tag == 'b' and not element.text and len(element) == 1
+        and element[0].tag == 'i' and element[0].text == 'Discussion'
+        and not len(element[0]) and not element[0].tail):
+        return
+
+    if element.text and isinstance(element.tag, basestring):
+        yield element.text
+    for child in element:
+        for text in minutes_text(child):
+            yield text
+        if child.tail:
+            yield child.tail
+
 class Command(BaseCommand):
 
     help = 'Check for new sources'
@@ -44,7 +126,7 @@ class Command(BaseCommand):
         make_option('--scrape-with-json',
             default=False,
             action='store_true',
-            help='Write JSON summaries (implies --scrape)',
+            help='Write JSON Lines summaries as the scrape goes (implies --scrape)',
         ),
         make_option('--save-json',
             default=False,
@@ -70,25 +152,30 @@ class Command(BaseCommand):
             default=0,
             action='store',
             type='int',
-            help='How far to go back (default not set means all the way)',
-            # note, this uses 'reportschecked'
+            help='How many reports to check for each committee (default not set means all the way)',
         ),
         make_option('--fetch-to-limit',
             default=False,
             action='store_true',
             help="Don't stop when reaching seen questions, continue to --limit",
         ),
+        make_option('--batch-size',
+            default=50,
+            type='int',
+            help='Number of documents to import into SayIt in each transaction (default 50)',
+        ),
+        make_option('--workers',
+            default=1,
+            type='int',
+            help='Number of committees to scrape, or reports to encode as JSON, at once (default 1)',
+        ),
     )
 
-    committees = []
-    allmembers = []
-    allreports = []
-    allappearances = []
+    json_outputs = {}
     numcommittees=0
     reportschecked=0
     reportsprocessed=0
     appearancesadded=0
-    totalappearances=0 # seems to be reset later, not really a good global
     name_re = "(Mr|Mrs|Ms|Miss|Dr|Prof|Professor|Prince|Princess) ([- a-zA-Z]{1,50}) \(([-A-Z]+)([;,][- A-Za-z]+)?\)"
     instance = None
     limit = 0
@@ -102,10 +189,22 @@ class Command(BaseCommand):
             raise CommandError("Instance specified not found (%s)" % options['instance'])
 
         self.retries = options['retries']
+        # --retries counts every attempt, the fetcher's retries only those
+        # after the first. It keeps the login cookies for the whole scrape,
+        # and its requests are spaced out by the shared HostScheduler (see
+        # za_hansard.fetch) rather than by sleeping after each report.
+        self.fetcher = Fetcher(retries=max(self.retries - 1, 0))
 
         self.limit          = options['limit']
         self.fetch_to_limit = options['fetch_to_limit']
 
+        # The counters are updated by every worker, see count().
+        self.counter_lock = threading.Lock()
+        # Guards the creation of report rows, and the meeting_urls of the
+        # reports being processed, see processReports.
+        self.report_lock = threading.Lock()
+        self.reports_in_progress = set()
+
         if options['scrape_with_json']:
             options['scrape'] = True
 
@@ -129,7 +228,7 @@ class Command(BaseCommand):
             }
 
         page=self.open_url_with_retries('http://www.pmg.org.za/user/login')
-        contents = page.read()
+        contents = page.content
         p = parslepy.Parselet(login_rules)
         login_data = p.parse_fromstring(contents)
         for attr in login_data['form']:
@@ -137,22 +236,16 @@ class Command(BaseCommand):
                 form_build_id=attr['value']
             if attr['name']=='form_id':
                 form_id=attr['value']
-        cj = cookielib.CookieJar()
-        opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj))
-        urllib2.install_opener(opener)
         data = {
             'form_id': form_id,
             'form_build_id': form_build_id,
             'name': settings.PMG_COMMITTEE_USER,
             'pass': settings.PMG_COMMITTEE_PASS,
             }
-        encodedata = urllib.urlencode(data)
-        req = urllib2.Request('http://www.pmg.org.za/user/login', encodedata)
-        resp = self.open_url_with_retries(req)
-        contents = resp.read()
+        self.fetcher.post('http://www.pmg.org.za/user/login', data)
 
         page=self.open_url_with_retries('http://www.pmg.org.za/committees')
-        contents = page.read()
+        contents = page.content
 
         committees_rules = {
             "heading": "h1.title",
@@ -169,95 +262,106 @@ class Command(BaseCommand):
         p = parslepy.Parselet(committees_rules)
         parsedcommittees = p.parse_fromstring(contents)
 
+        jobs = [
+            (ctype['type'], committee)
+            for ctype in parsedcommittees['committee_types']
+            for committee in ctype['committees']
+            ]
+
+        # Everything scraped is written out as it's found, as JSON Lines
+        # (see za_hansard.datejson.read_json_lines to load it again).
+        self.json_outputs = {}
+        if options['scrape_with_json']:
+            for name in ('committees', 'members', 'reports', 'appearances'):
+                self.json_outputs[name] = JsonLinesWriter('%s_json.jsonl' % name)
+
         self.stdout.write('Started\n')
         try:
-            for ctype in parsedcommittees['committee_types']:
-                for committee in ctype['committees']:
-                    self.numcommittees = self.numcommittees + 1
-
-                    try:
-                        self.processCommittee(
-                            'http://www.pmg.org.za'+committee['url'].replace(' ','%20'),
-                            committee['name'])
-                    except urllib2.HTTPError:
-                        #if there is an http error, just ignore this committee this time
-                        self.stderr.write('HTTPERROR '+committee['name'])
-                        pass
-                    finally:    
-                        self.updateprocess()
-                        self.committees.append({
-                            "name": committee['name'],
-                            "url": committee['url'],
-                            "type": ctype['type']
-                            })
+            if options['workers'] > 1:
+                # The workers share self.fetcher, and so its login cookies.
+                pool = ThreadPool(options['workers'])
+                try:
+                    for committee in pool.imap(self.crawlCommitteeInThread, jobs):
+                        self.writeJson('committees', committee)
+                finally:
+                    pool.terminate()
+                    pool.join()
+            else:
+                for job in jobs:
+                    self.writeJson('committees', self.crawlCommittee(job))
+        finally:
+            for output in self.json_outputs.values():
+                output.close()
+
+    def crawlCommittee(self, job):
+        """
+        Scrape a committee's members and reports, stopping at the first
+        report already seen (unless --fetch-to-limit) or at --limit.
+        """
+        (committee_type, committee) = job
+        self.count('numcommittees')
+
+        try:
+            self.processCommittee(
+                'http://www.pmg.org.za'+committee['url'].replace(' ','%20'),
+                committee['name'])
         except StopFetchingException as e:
-            self.stderr.write("STOPPED! %s\n" % e)
+            self.stderr.write("STOPPED %s! %s\n" % (committee['name'], e))
+        except FetchError:
+            #if there is an http error, just ignore this committee this time
+            self.stderr.write('HTTPERROR '+committee['name'])
+        finally:
+            self.updateprocess()
 
-        if options['scrape_with_json']:
-            with open('committees_json.json', 'w') as outfile:
-              json.dump(self.committees, outfile)
+        return {
+            "name": committee['name'],
+            "url": committee['url'],
+            "type": committee_type
+            }
 
-            with open('members_json.json', 'w') as outfile:
-              json.dump(self.allmembers, outfile)
+    def crawlCommitteeInThread(self, job):
+        try:
+            return self.crawlCommittee(job)
+        finally:
+            # Django opens a connection for each thread.
+            connection.close()
 
-            with open('reports_json.json', 'w') as outfile:
-              json.dump(self.allreports, outfile)
+    def writeJson(self, name, obj):
+        if name in self.json_outputs:
+            self.json_outputs[name].write(obj)
 
-            with open('appearances_json.json', 'w') as outfile:
-              json.dump(self.allappearances, outfile)
+    def count(self, counter, n=1):
+        with self.counter_lock:
+            setattr(self, counter, getattr(self, counter) + n)
 
     def updateprocess(self):
         self.stdout.write('Committee %d, Checked %d Reports, Processed %d, %d Appearances\n'
             % (self.numcommittees, self.reportschecked, self.reportsprocessed, self.appearancesadded))
 
     def open_url_with_retries(self, url):
-        for i in range(0, self.retries):
-            try:
-                page=urllib2.urlopen(url)
-                return page
-            except Exception as e:
-                print >> sys.stderr, "attempt %d: Exception caught '%s'" % (i, str(e))
-                time.sleep(1)
-
-        # we didn't ever return, so
-        raise Exception("Cannot connect to server for url '%s' and max retries exceeded" % url)
+        # raises FetchError once every attempt has failed
+        return self.fetcher.get(url)
 
     def processReport(self, row, url,committeeName,committeeURL,meetingDate):
         #get the appearances in the report
 
         meetingDate = datetime.strptime(meetingDate, '%d %b %Y')
 
-        self.reportsprocessed = self.reportsprocessed + 1
+        self.count('reportsprocessed')
         self.updateprocess()
-        report_rules = {
-            "heading": "h1.title",
-            "chairperson": "div.field-field-chairperson",
-            "paragraphs(.field-field-minutes p.MsoNormal)": ["."]
-            }
         page=self.open_url_with_retries(url)
-        contents = page.read()
-        p = parslepy.Parselet(report_rules)
-        report = p.parse_fromstring(contents)
-        self.totalappearances=0
-
-        soup = BeautifulSoup(contents)
-        #use BeautifulSoup due to issues with <br/> divisions when using Parslepy
-        text=(
-            unicode(soup.find('div',class_='field-field-minutes'))
-            .replace('<br/>','')
-            .replace('<div>','')
-            .replace('</div>','')
-            .replace('<p>','')
-            .replace('</p>','')
-            .replace('\t','')
-            .replace('<b><i>Discussion</i></b>',''))
-        paragraphs = text.split("\n")
+        report = extract_report(page.content)
 
+        # The appearances are collected here and written all at once. A
+        # person is only added once for each meeting, whether they're named
+        # as a chair or in the paragraphs.
+        appearances = []
+        seen = set()
+
+        paragraphs = report['minutes']
         if len(paragraphs)<3 and len(report['paragraphs'])>1:
             paragraphs = report['paragraphs']
 
-        PMGCommitteeAppearance.objects.filter(report = row).delete()
-
         if 'chairperson' not in report:
             report['chairperson']=""
 
@@ -280,12 +384,9 @@ class Command(BaseCommand):
                         '%s %s (%s) chaired the meeting.' % (
                             chair[0], chair[1], chair[2]))
                     }
-                PMGCommitteeAppearance.objects.create(**save)
-
-                self.appearancesadded = self.appearancesadded + 1
-
-                self.allappearances.append(save)
-                self.totalappearances = self.totalappearances + 1
+                if (save['person'], url) not in seen:
+                    appearances.append(save)
+                    seen.add((save['person'], url))
 
         if len(chairs) is 1:
             findchair=True
@@ -317,17 +418,9 @@ class Command(BaseCommand):
                             .replace("\n",''),
                          }
 
-                    (obj, created) = PMGCommitteeAppearance.objects.get_or_create(
-                        person = name,
-                        meeting_url = url,
-                        defaults = save,
-                        )
-
-                    if created:
-                        self.appearancesadded = self.appearancesadded + 1
-
-                        self.allappearances.append(save)
-                        self.totalappearances = self.totalappearances + 1
+                    if (name, url) not in seen:
+                        appearances.append(save)
+                        seen.add((name, url))
 
             if findchair:
                 if "The Chairperson" in paragraph:
@@ -348,107 +441,145 @@ class Command(BaseCommand):
                             .replace("\n",' '),
                         }
 
-                    obj = PMGCommitteeAppearance.objects.create(**save)
-                    self.appearancesadded = self.appearancesadded + 1
-                    self.allappearances.append(save)
-                    self.totalappearances = self.totalappearances + 1
-
-        if self.totalappearances > 0:
-            PMGCommitteeReport.objects.filter(meeting_url = url).update( processed = True)
-
-        # finally sleep, to minimize load on PMG servers
-        time.sleep(1)
-
-    def processReports(self, url,processingcommitteeName,processingcommitteeURL):
-        #get reports on this page, process them, proceed to next page
-
+                    if (save['person'], url) not in seen:
+                        appearances.append(save)
+                        seen.add((save['person'], url))
+
+        with transaction.commit_on_success():
+            PMGCommitteeAppearance.objects.filter(report = row).delete()
+            PMGCommitteeAppearance.objects.bulk_create(
+                [PMGCommitteeAppearance(**save) for save in appearances])
+            if appearances:
+                PMGCommitteeReport.objects.filter(meeting_url = url).update( processed = True)
+
+        self.count('appearancesadded', len(appearances))
+        for save in appearances:
+            # The report row is left out, its meeting_url identifies it.
+            self.writeJson('appearances', dict(
+                (key, value) for (key, value) in save.items() if key != 'report'))
+
+    reports_rules = {
+        "heading":"h1.title",
+        "reports(div.view-reports-by-committee table tr)": [{
+            "date": "td.views-field-field-meeting-date-value",
+            "meeting": "td.views-field-title",
+            "url": "a @href",
+            "image": "td.views-field-phpcode img @src"
+            }],
+        "next": "li.pager-next a @href"
+    }
+
+    def fetchReportsPage(self, url):
         page=self.open_url_with_retries(url)
-        contents = page.read()
-
-        reports_rules = {
-            "heading":"h1.title",
-            "reports(div.view-reports-by-committee table tr)": [{
-                "date": "td.views-field-field-meeting-date-value",
-                "meeting": "td.views-field-title",
-                "url": "a @href",
-                "image": "td.views-field-phpcode img @src"
-                }],
-            "next": "li.pager-next a @href"
-        }
-        p = parslepy.Parselet(reports_rules)
-        reports = p.parse_fromstring(contents)
-
-        for report in reports['reports']:
-
-            if self.limit and (self.reportschecked > self.limit):
-                raise StopFetchingException("Reached Limit")
+        p = parslepy.Parselet(self.reports_rules)
+        return p.parse_fromstring(page.content)
+
+    def reportRows(self, url):
+        """
+        Generate the rows of a committee's report listing, following the
+        pager from url. The next page is fetched in the background while
+        the rows of the current one are being processed, and each page is
+        dropped once its rows are done.
+        """
+        pool = ThreadPool(1)
+        try:
+            pending = pool.apply_async(self.fetchReportsPage, (url,))
+            while pending:
+                reports = pending.get()
+                if "next" in reports:
+                    pending = pool.apply_async(
+                        self.fetchReportsPage,
+                        ('http://www.pmg.org.za'+reports['next'],))
+                else:
+                    pending = None
+
+                rows = reports['reports']
+                del reports
+                for report in rows:
+                    yield report
+        finally:
+            pool.terminate()
+            pool.join()
 
-            self.updateprocess()
-            if "date" in report:
-                self.reportschecked = self.reportschecked + 1
-                if report['date'] != '' and report['date'] != '':
-                    if (len(report)>0 and "date" in report
-                        and "meeting" in report and "url" in report
-                        and time.strptime(report['date'],'%d %b %Y')
-                            > time.strptime('22 Apr 2009','%d %b %Y')):
-                        self.allreports.append({
-                            "date": report['date'],
-                            "meeting": report['meeting'],
-                            "url": report['url'],
-                            "committee": processingcommitteeName})
-
-                        meeting_url = 'http://www.pmg.org.za'+report['url']
-                        try:
-                            row = PMGCommitteeReport.objects.filter(
-                                meeting_url = meeting_url)[0]
-                        except IndexError:
-                            row = None
-
-                        if not row:
-
-                            if not 'image' in report:
-                                report['image']=''
-
-                            if 'tick.png' in report['image']:
-                                ispremium=0
-                            else:
-                                ispremium=1
-
-                            row = PMGCommitteeReport.objects.create(
-                                premium = ispremium,
-                                processed = False,
-                                meeting_url = meeting_url)
-
-                            self.processReport(
-                                row,
-                                'http://www.pmg.org.za'+report['url'],
-                                processingcommitteeName,
-                                processingcommitteeURL,
-                                report['date'])
-
-                        elif not row.processed:
-
-                            self.processReport(
-                                row,
-                                'http://www.pmg.org.za'+report['url'],
-                                processingcommitteeName,
-                                processingcommitteeURL,
-                                report['date'])
-
-                        elif not self.fetch_to_limit:
-                            raise StopFetchingException("Reached previously seen report")
-
-        if "next" in reports:
-
-            self.processReports(
-                'http://www.pmg.org.za'+reports['next'],
-                processingcommitteeName,
-                processingcommitteeURL)
+    def processReports(self, url,processingcommitteeName,processingcommitteeURL):
+        #get the committee's reports, page by page, and process them
+        checked = 0
+
+        # closing() stops the prefetching as soon as the crawl stops.
+        with closing(self.reportRows(url)) as rows:
+            for report in rows:
+
+                if self.limit and (checked > self.limit):
+                    raise StopFetchingException("Reached Limit")
+
+                self.updateprocess()
+                if "date" in report:
+                    checked = checked + 1
+                    self.count('reportschecked')
+                    if report['date'] != '' and report['date'] != '':
+                        if (len(report)>0 and "date" in report
+                            and "meeting" in report and "url" in report
+                            and time.strptime(report['date'],'%d %b %Y')
+                                > time.strptime('22 Apr 2009','%d %b %Y')):
+                            self.writeJson('reports', {
+                                "date": report['date'],
+                                "meeting": report['meeting'],
+                                "url": report['url'],
+                                "committee": processingcommitteeName})
+
+                            meeting_url = 'http://www.pmg.org.za'+report['url']
+                            # Joint meetings are listed under each committee,
+                            # so make sure only one worker creates the row,
+                            # and only one processes the report at a time.
+                            with self.report_lock:
+                                try:
+                                    row = PMGCommitteeReport.objects.filter(
+                                        meeting_url = meeting_url)[0]
+                                except IndexError:
+                                    row = None
+
+                                if not row:
+
+                                    if not 'image' in report:
+                                        report['image']=''
+
+                                    if 'tick.png' in report['image']:
+                                        ispremium=0
+                                    else:
+                                        ispremium=1
+
+                                    row = PMGCommitteeReport.objects.create(
+                                        premium = ispremium,
+                                        processed = False,
+                                        meeting_url = meeting_url)
+
+                                claimed = (not row.processed and
+                                    meeting_url not in self.reports_in_progress)
+                                if claimed:
+                                    self.reports_in_progress.add(meeting_url)
+
+                            if claimed:
+                                try:
+                                    self.processReport(
+                                        row,
+                                        'http://www.pmg.org.za'+report['url'],
+                                        processingcommitteeName,
+                                        processingcommitteeURL,
+                                        report['date'])
+                                finally:
+                                    with self.report_lock:
+                                        self.reports_in_progress.discard(meeting_url)
+
+                            # A report that another worker is processing
+                            # doesn't count as seen, as it's only marked as
+                            # processed if it has appearances.
+                            elif row.processed and not self.fetch_to_limit:
+                                raise StopFetchingException("Reached previously seen report")
 
     def processCommittee(self, url,processingcommitteeName):
         #opens the committee, gets the memberrs, starts retrieving reports
         page=self.open_url_with_retries(url)
-        contents = page.read()
+        contents = page.content
 
         members_rules = {
             "heading": "h1.title",
@@ -478,80 +609,133 @@ class Command(BaseCommand):
                 member['isChairperson']=False
 
             member['committee']=processingcommitteeName
-            self.allmembers.append(member)
+            self.writeJson('members', member)
 
         self.processReports( url, processingcommitteeName, url )
 
-    def save_json(self, *args, **options):
-
-        reports = PMGCommitteeReport.objects.all()
+    appearance_fields = (
+        'meeting_date', 'committee_url', 'committee', 'meeting',
+        'party', 'person', 'meeting_url', 'text')
+    report_batch_size = 100
 
-        for report in reports:
-
-            appearances = report.appearances.all()
-
-            if not len(appearances):
-                continue
-
-            first_appearance = appearances[0]
-
-            speeches = []
-            for row in appearances:
-                speeches.append({
-                        'party': row.party,
-                        'personname': row.person,
-                        'text': row.text,
-                        'tags': ['committee']
-                        })
-            tosave={
-                    # TODO, really these fields belong to report, not to first appearance row
-                    'committee_url': first_appearance.committee_url,
-                    'organization':  first_appearance.committee,
-                    'title':         first_appearance.meeting,
-                    'report_url':    first_appearance.meeting_url,
-                    'date':          first_appearance.meeting_date,
-                    'public':        bool(not report.premium),
-                    'speeches':      speeches,
-                    'parent_section_titles': [
-                        'Committee Minutes',
-                        first_appearance.committee,
-                        first_appearance.meeting_date.strftime('%d %B %Y')
-                        ]}
-
-
-            filename = os.path.join(settings.COMMITTEE_CACHE, '%d.json' % report.id)
-            with open(filename, 'w') as outfile:
-                json.dump(tosave, outfile, indent=1, cls=DateEncoder)
+    def save_json(self, *args, **options):
+        """
+        Write each report that has appearances to a JSON file in
+        COMMITTEE_CACHE, for importing into SayIt.
+
+        A manifest in COMMITTEE_CACHE records a signature of the
+        appearances each file was written from, and only the reports whose
+        appearances have changed since (or whose files are missing) are
+        written again. With --workers, the JSON is encoded by that many
+        processes.
+        """
+        workers = options.get('workers', 1)
+
+        manifest_path = os.path.join(settings.COMMITTEE_CACHE, 'manifest.json')
+        try:
+            with open(manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+        except (IOError, ValueError):
+            manifest = {}
+
+        if workers > 1:
+            pool = process_pool(workers)
+            encode_map = pool.imap_unordered
+        else:
+            pool = None
+            encode_map = itertools.imap
+
+        reports = PMGCommitteeReport.objects.order_by('id').prefetch_related('appearances')
+        written = unchanged = 0
+        try:
+            last_id = 0
+            while True:
+                batch = list(reports.filter(id__gt=last_id)[:self.report_batch_size])
+                if not batch:
+                    break
+                last_id = batch[-1].id
+
+                jobs = []
+                for report in batch:
+                    appearances = sorted(report.appearances.all(), key=lambda a: a.id)
+                    if not appearances:
+                        continue
+
+                    signature = hashlib.sha1(repr((
+                        report.premium,
+                        [[getattr(a, field) for field in self.appearance_fields]
+                         for a in appearances],
+                        ))).hexdigest()
+                    filename = os.path.join(settings.COMMITTEE_CACHE, '%d.json' % report.id)
+                    if manifest.get(str(report.id)) == signature and os.path.exists(filename):
+                        unchanged += 1
+                        continue
+
+                    jobs.append((filename, self.report_json(report, appearances)))
+                    manifest[str(report.id)] = signature
+
+                for (filename, data) in encode_map(encode_json, jobs):
+                    write_atomically(filename, data)
+                    written += 1
+
+                # Saved after each batch, so that an interrupted run doesn't
+                # rewrite the files it got through.
+                write_atomically(manifest_path, json.dumps(manifest))
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        self.stdout.write('Wrote %d reports (%d unchanged)\n' % (written, unchanged))
+
+    def report_json(self, report, appearances):
+        first_appearance = appearances[0]
+
+        speeches = []
+        for row in appearances:
+            speeches.append({
+                    'party': row.party,
+                    'personname': row.person,
+                    'text': row.text,
+                    'tags': ['committee']
+                    })
+        return {
+                # TODO, really these fields belong to report, not to first appearance row
+                'committee_url': first_appearance.committee_url,
+                'organization':  first_appearance.committee,
+                'title':         first_appearance.meeting,
+                'report_url':    first_appearance.meeting_url,
+                'date':          first_appearance.meeting_date,
+                'public':        bool(not report.premium),
+                'speeches':      speeches,
+                'parent_section_titles': [
+                    'Committee Minutes',
+                    first_appearance.committee,
+                    first_appearance.meeting_date.strftime('%d %B %Y')
+                    ]}
 
     def import_to_sayit(self, *args, **options):
 
-        sections = []
         sources = PMGCommitteeReport.objects
         if not options['delete_existing']:
             sources = sources.filter(sayit_section = None)
 
         sources_all = sources.all()
 
-        for row in sources_all:
-            filename = os.path.join(settings.COMMITTEE_CACHE, '%d.json' % row.id)
-            if not os.path.exists(filename):
-                continue
-
-            importer = ImportJson( instance=self.instance, delete_existing = options['delete_existing'],
-                popit_url='http://za-peoples-assembly.popit.mysociety.org/api/v0.1/')
-            try:
+        def documents():
+            for row in sources_all:
+                filename = os.path.join(settings.COMMITTEE_CACHE, '%d.json' % row.id)
+                if not os.path.exists(filename):
+                    continue
                 self.stdout.write("TRYING %d (%s)\n" % (row.id, filename))
-                section = importer.import_document(filename)
-
-                row.sayit_section = section
-                row.last_sayit_import = datetime.now().date()
-                row.save()
-
-                sections.append(section)
-
-            except Exception as e:
-                self.stderr.write('WARN: failed to import %d: %s' %
-                    (row.id, str(e)))
+                yield (row, filename)
+
+        importer = ImportJson( instance=self.instance, delete_existing = options['delete_existing'],
+            popit_url='http://za-peoples-assembly.popit.mysociety.org/api/v0.1/')
+        sections = import_documents(
+            importer, PMGCommitteeReport, documents(),
+            batch_size=options['batch_size'],
+            log=lambda message: self.stderr.write('WARN: %s\n' % message))
 
         self.stdout.write( str( [s.id for s in sections] ) )
         self.stdout.write( '\n' )
@@ -0,0 +1,50 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from za_hansard.downloader import SourceDownloader, prefetch_sources
+from za_hansard.fetch import Fetcher
+from za_hansard.models import Source
+
+class Command(BaseCommand):
+    help = 'Download the documents for sources that need processing into the cache'
+    option_list = BaseCommand.option_list + (
+        make_option('--workers',
+            default=4,
+            type='int',
+            help='Number of downloads to run at once (default 4)',
+        ),
+        make_option('--interval',
+            type='float',
+            help='Minimum seconds between requests to the same host (default FETCH_MIN_INTERVAL)',
+        ),
+        make_option('--retries',
+            default=2,
+            type='int',
+            help='Times to retry a download after a network or server error (default 2)',
+        ),
+        make_option('--limit',
+            default=0,
+            type='int',
+            help='limit query (default 0 for none)',
+        ),
+    )
+
+    def handle(self, *args, **options):
+        limit = options['limit']
+
+        sources = Source.objects.all().requires_processing()
+        sources = sources[:limit] if limit else sources
+
+        fetcher = Fetcher(
+            interval=options['interval'],
+            retries=options['retries'],
+            pool_size=options['workers'],
+            )
+        downloader = SourceDownloader(workers=options['workers'], fetcher=fetcher)
+        (downloaded, failed) = prefetch_sources(
+            sources,
+            downloader=downloader,
+            log=lambda message: self.stderr.write('WARN: %s\n' % message))
+
+        self.stdout.write('Downloaded %d sources (%d failed)\n' % (downloaded, failed))
@@ -1,4 +1,3 @@
-import urllib2
 import sys
 import re, os
 import dateutil.parser
@@ -6,18 +5,26 @@ import string
 import parslepy
 import json
 import time
+import itertools
+import threading
+import Queue
 
 import subprocess
 
 from datetime import datetime, date, timedelta
 
+from multiprocessing.pool import ThreadPool
 from optparse import make_option
 
 from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
-from django.db.models import Q
+from django.db import transaction
 
-from za_hansard.models import Question, Answer, QuestionPaper
+from za_hansard import fetch
+from za_hansard.conversion_cache import write_atomically
+from za_hansard.models import Question, Answer, QuestionPaper, bulk_update
+from za_hansard.pools import process_pool
+from za_hansard.sayit_import import import_documents
 from speeches.importers.import_json import ImportJson
 from instances.models import Instance
 
@@ -39,6 +46,38 @@ def strip_dict(d):
     """
     return dict((k, v.strip() if 'strip' in dir(v) else v) for k, v in d.items())
 
+def download_answer(job):
+    """
+    Download an answer's document to filename, unless it's already there.
+
+    job is a tuple of the answer's id, url and filename. Returns the id,
+    the filename and any za_hansard.fetch.FetchError.
+    """
+    (answer_id, url, filename) = job
+
+    if not os.path.exists(filename):
+        try:
+            write_atomically(filename, fetch.get(url).content)
+        except fetch.FetchError as e:
+            return (answer_id, filename, e)
+
+    return (answer_id, filename, None)
+
+def extract_answer_text(job):
+    """
+    Extract the text of the answer document in filename, for running in a
+    process pool.
+
+    job is a tuple of the answer's id and the filename. Returns the id, the
+    text and whether antiword failed.
+    """
+    (answer_id, filename) = job
+
+    try:
+        return (answer_id, question_scraper.extract_answer_text_from_word_document(filename), False)
+    except subprocess.CalledProcessError:
+        return (answer_id, None, True)
+
 class Command(BaseCommand):
 
     help = 'Check for new sources'
@@ -94,6 +133,21 @@ class Command(BaseCommand):
             action='store_true',
             help="Don't stop when reaching seen questions, continue to --limit",
         ),
+        make_option('--batch-size',
+            default=50,
+            type='int',
+            help='Number of documents to import into SayIt in each transaction (default 50)',
+        ),
+        make_option('--answer-batch-size',
+            default=100,
+            type='int',
+            help='Number of answers to download and process before saving them (default 100)',
+        ),
+        make_option('--workers',
+            default=1,
+            type='int',
+            help='Number of question papers or answers to download and process at once (default 1)',
+        ),
     )
 
     start_url_q = ('http://www.parliament.gov.za/live/', 'content.php?Category_ID=236')
@@ -123,6 +177,8 @@ class Command(BaseCommand):
             raise CommandError("Please supply a valid option")
 
     def scrape_questions(self, *args, **options):
+        if options.get('workers', 1) > 1:
+            return self.scrape_questions_pipelined(*args, **options)
 
         start_url = self.start_url_q[0] + self.start_url_q[1]
         details = question_scraper.QuestionDetailIterator(start_url)
@@ -173,6 +229,165 @@ class Command(BaseCommand):
 
         self.stdout.write( "Processed %d documents (%d errors)\n" % (count, errors) )
 
+    def scrape_questions_pipelined(self, *args, **options):
+        """
+        Scrape questions as scrape_questions does, but with the stages for
+        different papers overlapping:
+
+        - a thread working through the listing pages,
+        - --workers threads downloading the PDFs,
+        - a pool of --workers processes running pdftohtml and parsing,
+        - and this thread saving the results, and writing out what each
+          stage had to say about them, in listing order.
+
+        Each stage only gets a little ahead of the next, so a stop at a
+        seen paper or at --limit doesn't cause much unneeded work.
+        """
+        workers = options['workers']
+        start_url = self.start_url_q[0] + self.start_url_q[1]
+
+        # The papers we have, added to by this thread as papers are saved.
+        seen_urls = set(QuestionPaper.objects.values_list('source_url', flat=True))
+
+        pool = process_pool(workers)
+
+        downloads = Queue.Queue(maxsize=workers * 2)
+        # Items of (sequence number, detail, message or AsyncResult), or
+        # (None, number of details, exception) once the listing is done.
+        results = Queue.Queue(maxsize=workers * 2)
+        stopping = threading.Event()
+
+        def list_papers():
+            count = 0
+            error = None
+            try:
+                for detail in question_scraper.QuestionDetailIterator(start_url):
+                    if stopping.is_set():
+                        break
+
+                    message = None
+                    stop = False
+                    if detail['language']=='English' and detail['type']=='pdf':
+                        if detail['url'] in seen_urls:
+                            message = 'SKIPPING as file already handled\n'
+                            if not options['fetch_to_limit']:
+                                message += "Stopping as '--fetch-to-limit' not given\n"
+                                stop = True
+                    elif detail['language']=='English':
+                        message = 'SKIPPING as not a pdf\n'
+                    else:
+                        # presumably non-English
+                        message = 'SKIPPING presumably not English\n'
+
+                    if message:
+                        results.put((count, detail, message))
+                    else:
+                        downloads.put((count, detail))
+                    count += 1
+
+                    if stop:
+                        break
+                    if options['limit'] and count >= options['limit']:
+                        break
+            except Exception as e:
+                error = e
+            finally:
+                for i in range(workers):
+                    downloads.put(None)
+                results.put((None, count, error))
+
+        def download_papers():
+            while True:
+                job = downloads.get()
+                if job is None:
+                    return
+                (count, detail) = job
+                if stopping.is_set():
+                    results.put((count, detail, 'SKIPPING as stopping\n'))
+                    continue
+                try:
+                    parser = question_scraper.QuestionPaperParser(**detail)
+                    pdfdata = parser.download_question_pdf(detail['url'])
+                    result = pool.apply_async(
+                        question_scraper.parse_question_paper, (detail, pdfdata))
+                except fetch.FetchError:
+                    result = ' SKIPPING - Bad response\n'
+                except Exception as e:
+                    result = e
+                results.put((count, detail, result))
+
+        threads = [threading.Thread(target=list_papers)] + [
+            threading.Thread(target=download_papers) for i in range(workers)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        total = None
+        listing_error = None
+        errors = 0
+        pending = {}
+        next_count = 0
+        stop = False
+        try:
+            while not stop and (total is None or next_count < total):
+                (count, detail, result) = results.get()
+                if count is None:
+                    (total, listing_error) = (detail, result)
+                    continue
+                pending[count] = (detail, result)
+
+                while not stop and next_count in pending:
+                    (detail, result) = pending.pop(next_count)
+                    next_count += 1
+
+                    self.stdout.write(
+                        "{count:5} {url} ".format(count=next_count, url=detail['url']))
+                    if isinstance(result, basestring):
+                        self.stdout.write(result)
+                        continue
+
+                    # The listing may have got to a paper listed twice
+                    # before we had saved it the first time.
+                    if detail['url'] in seen_urls:
+                        self.stdout.write('SKIPPING as file already handled\n')
+                        if not options['fetch_to_limit']:
+                            self.stdout.write("Stopping as '--fetch-to-limit' not given\n")
+                            stop = True
+                        continue
+
+                    try:
+                        if isinstance(result, Exception):
+                            raise result
+                        self.stdout.write('PROCESSING')
+                        (output, parsed) = result.get()
+                        self.stdout.write(output)
+                        if parsed:
+                            parser = question_scraper.QuestionPaperParser(**detail)
+                            parser.save_questions(*parsed)
+                            if parser.question_paper:
+                                seen_urls.add(detail['url'])
+                    except Exception as e:
+                        self.stdout.write('ERROR handling {0}: {1}\n'.format(detail['url'], str(e)))
+                        errors += 1
+        finally:
+            stopping.set()
+            pool.terminate()
+            pool.join()
+
+            # Let the other threads see that we're stopping, rather than
+            # leaving them blocked on a full queue.
+            for thread in threads:
+                while thread.is_alive():
+                    try:
+                        results.get(timeout=0.1)
+                    except Queue.Empty:
+                        pass
+
+        self.stdout.write( "Processed %d documents (%d errors)\n" % (next_count, errors) )
+
+        if listing_error:
+            raise listing_error
+
 
     def scrape_answers(self, *args, **options):
         start_url = self.start_url_a[0] + self.start_url_a[1]
@@ -218,77 +433,142 @@ class Command(BaseCommand):
                 break
 
     def process_answers(self, *args, **options):
+        """
+        Download and extract the text of the answers that haven't been
+        processed yet, saving them --answer-batch-size answers at a time.
+
+        With --workers, the answers in each batch are downloaded by that
+        many threads and their text extracted by that many processes.
+        """
+        workers = options.get('workers', 1)
+        batch_size = options.get('answer_batch_size', 100)
+
         answers = Answer.objects.exclude(url=None)
-        unprocessed = answers.exclude(processed_code=Answer.PROCESSED_OK)
+        unprocessed = answers.exclude(processed_code=Answer.PROCESSED_OK).order_by('id')
 
-        self.stdout.write("Processing %d records" % len(unprocessed))
+        self.stdout.write("Processing %d records" % unprocessed.count())
 
-        for row in unprocessed:
-            filename = os.path.join(
-                settings.ANSWER_CACHE,
-                '%d.%s' % (row.id, row.type))
+        if workers > 1:
+            extract_pool = process_pool(workers)
+            thread_pool = ThreadPool(workers)
+            download_map = thread_pool.imap_unordered
+            extract_map = extract_pool.imap_unordered
+        else:
+            extract_pool = thread_pool = None
+            download_map = extract_map = itertools.imap
 
-            if os.path.exists(filename):
-                self.stdout.write('-')
+        try:
+            last_id = 0
+            while True:
+                rows = list(
+                    unprocessed.filter(id__gt=last_id)
+                    .values_list('id', 'url', 'type')[:batch_size])
+                if not rows:
+                    break
+                last_id = rows[-1][0]
+
+                self.process_answer_batch(rows, download_map, extract_map)
+        finally:
+            for pool in (thread_pool, extract_pool):
+                if pool:
+                    pool.terminate()
+                    pool.join()
+
+    def process_answer_batch(self, rows, download_map, extract_map):
+        jobs = [
+            (answer_id, url, os.path.join(settings.ANSWER_CACHE, '%d.%s' % (answer_id, type)))
+            for (answer_id, url, type) in rows
+            ]
+
+        downloaded = []
+        http_errors = []
+        for (answer_id, filename, error) in download_map(download_answer, jobs):
+            if not error:
+                downloaded.append((answer_id, filename))
                 continue
 
-            self.stdout.write('.')
-
-            try:
-                download = urllib2.urlopen(row.url)
-                with open(filename, 'wb') as save:
-                    save.write(download.read())
+            if error.status is not None:
+                http_errors.append(answer_id)
+                self.stderr.write('ERROR HTTPError while processing %d\n' % answer_id)
+            else:
+                self.stderr.write('ERROR URLError while processing %d\n' % answer_id)
 
-                try:
-                    text = question_scraper.extract_answer_text_from_word_document(filename)
-                    row.processed_code = Answer.PROCESSED_OK
-                    row.text = text
-                    row.save()
-                except subprocess.CalledProcessError:
-                    self.stdout.write('ERROR in antiword processing %d\n' % row.id)
+        texts = {}
+        for (answer_id, text, error) in extract_map(extract_answer_text, downloaded):
+            self.stdout.write('.')
+            if error:
+                self.stdout.write('ERROR in antiword processing %d\n' % answer_id)
+            else:
+                texts[answer_id] = text
 
-            except urllib2.HTTPError:
-                row.processed_code = Answer.PROCESSED_HTTP_ERROR
-                row.save()
-                self.stderr.write('ERROR HTTPError while processing %d\n' % row.id)
+        with transaction.commit_on_success():
+            bulk_update(Answer, 'text', texts)
+            Answer.objects.filter(id__in=texts.keys()).update(
+                processed_code=Answer.PROCESSED_OK)
+            Answer.objects.filter(id__in=http_errors).update(
+                processed_code=Answer.PROCESSED_HTTP_ERROR)
 
-            except urllib2.URLError:
-                self.stderr.write('ERROR URLError while processing %d\n' % row.id)
+    # The numbers that link answers to questions, from both sequences for
+    # ordinary questions and the president's and deputy president's own.
+    match_fields = ('written_number', 'oral_number', 'president_number', 'dp_number')
 
     def match_answers(self, *args, **options):
-        # FIXME - should change to a subset of all answers.
-        for answer in Answer.objects.all():
-            written_q = Q(written_number=answer.written_number)
-            oral_q = Q(oral_number=answer.oral_number)
-
-            if answer.written_number and answer.oral_number:
-                query = written_q | oral_q
-            elif answer.written_number:
-                query = written_q
-            elif answer.oral_number:
-                query = oral_q
-            else:
+        answers = list(
+            Answer.objects
+            .filter(question__isnull=True)
+            .values_list('id', 'document_name', 'house', 'year', *self.match_fields))
+
+        # Index the questions from each (house, year) that has an unmatched
+        # answer, by each of their numbers.
+        buckets = set((a[2], a[3]) for a in answers)
+        questions = {}
+        for (house, year) in buckets:
+            candidates = (
+                Question.objects
+                .filter(house=house, year=year)
+                .values_list('id', *self.match_fields))
+            for row in candidates:
+                for (field, number) in zip(self.match_fields, row[1:]):
+                    if number is not None:
+                        questions[(house, year, field, number)] = row[0]
+
+        links = {}
+        for row in answers:
+            (answer_id, document_name, house, year) = row[:4]
+            numbers = [
+                (field, number)
+                for (field, number) in zip(self.match_fields, row[4:])
+                if number is not None
+                ]
+            if not numbers:
                 sys.stdout.write(
-                    "Answer {0} {1} has no written or oral number - SKIPPING\n"
-                    .format(answer.id, answer.document_name)
+                    "Answer {0} {1} has no written, oral, president or dp number - SKIPPING\n"
+                    .format(answer_id, document_name)
                     )
                 continue
 
-            try:
-                question = Question.objects.get(
-                    query,
-                    year=answer.year,
-                    house=answer.house,
+            matches = set(
+                questions[key]
+                for key in ((house, year, field, number) for (field, number) in numbers)
+                if key in questions)
+
+            if not matches:
+                sys.stdout.write(
+                    "No question found for {0} {1}\n"
+                    .format(answer_id, document_name)
                     )
-            except Question.DoesNotExist:
+                continue
+            if len(matches) > 1:
                 sys.stdout.write(
-                    "No question found for {0} {1}"
-                    .format(answer.id, answer.document_name)
+                    "Several questions found for {0} {1} - SKIPPING\n"
+                    .format(answer_id, document_name)
                     )
                 continue
 
-            question.answer = answer
-            question.save()
+            links[matches.pop()] = answer_id
+
+        bulk_update(Question, 'answer', links)
+        sys.stdout.write("Matched {0} answers\n".format(len(links)))
 
     def qa_to_json(self, *args, **options):
         questions = (Question.objects
@@ -405,26 +685,22 @@ class Command(BaseCommand):
                 .filter(answer__processed_code = Answer.PROCESSED_OK)
                 )
 
-        sections = []
-        for question in questions:
-            path = os.path.join(
-                settings.ANSWER_CACHE,
-                "%d.json" % question.id)
-            if not os.path.exists(path):
-                continue
-
-            importer = ImportJson( instance=instance,
-                popit_url='http://za-peoples-assembly.popit.mysociety.org/api/v0.1/')
-            #try:
-            self.stderr.write("TRYING %s\n" % path)
-            section = importer.import_document(path)
-            sections.append(section)
-            question.sayit_section = section
-            question.last_sayit_import = datetime.now().date()
-            question.save()
-            #except Exception as e:
-                #self.stderr.write('WARN: failed to import %d: %s' %
-                    #(question.id, str(e)))
+        def documents():
+            for question in questions:
+                path = os.path.join(
+                    settings.ANSWER_CACHE,
+                    "%d.json" % question.id)
+                if not os.path.exists(path):
+                    continue
+                self.stderr.write("TRYING %s\n" % path)
+                yield (question, path)
+
+        importer = ImportJson( instance=instance,
+            popit_url='http://za-peoples-assembly.popit.mysociety.org/api/v0.1/')
+        sections = import_documents(
+            importer, Question, documents(),
+            batch_size=options['batch_size'],
+            log=lambda message: self.stderr.write('WARN: %s\n' % message))
 
         self.stdout.write( str( [s.id for s in sections] ) )
         self.stdout.write( '\n' )
@@ -1,10 +1,10 @@
-
 # This script changed extensively when the Kenyan Parliament website changed after the 2013 Election.
 #
 # The previous version can be seen at:
 #
 #    https://github.com/mysociety/mzalendo/blob/7181e30519b140229e3817786e4a7440ac08288d/mzalendo/hansard/management/commands/hansard_check_for_new_sources.py
 
+import os
 import pprint
 import httplib2
 import re
@@ -19,12 +19,42 @@ from django.conf import settings
 from django.core.management.base import BaseCommand, CommandError
 from optparse import make_option
 
+from za_hansard.conversion_cache import move_into_place, temporary_file
+from za_hansard.downloader import SourceDownloader, prefetch_sources
 from za_hansard.models import Source, SourceUrlCouldNotBeRetrieved
+from za_hansard.pools import process_pool
 from za_hansard.parse import ZAHansardParser
 
 class FailedToRetrieveSourceException (Exception):
     pass
 
+def parse_to_xml(filename):
+    """
+    Parse a downloaded source and write its Akoma Ntoso XML alongside it.
+
+    The XML is streamed to a temporary file as it is parsed, which is only
+    renamed into place once the parse has succeeded.
+    """
+    xml_filename = '%s.xml' % filename
+    (fd, temp_filename) = temporary_file(xml_filename)
+    try:
+        with os.fdopen(fd, 'wb') as output:
+            ZAHansardParser.parse_to_file(filename, output)
+        move_into_place(temp_filename, xml_filename)
+    except:
+        os.remove(temp_filename)
+        raise
+
+def parse_worker(filename):
+    """
+    Run parse_to_xml in a pool worker, returning an error message rather than
+    raising so that one bad document doesn't take down the whole pool.
+    """
+    try:
+        parse_to_xml(filename)
+    except Exception as e:
+        return str(e)
+
 class Command(BaseCommand):
     help = 'Parse unparsed'
     option_list = BaseCommand.option_list + (
@@ -52,6 +82,21 @@ class Command(BaseCommand):
             type='int',
             help='limit query (default 0 for none)',
         ),
+        make_option('--workers',
+            default=1,
+            type='int',
+            help='Number of parsing processes to run (default 1, no pool)',
+        ),
+        make_option('--batch-size',
+            default=50,
+            type='int',
+            help='Number of parsed sources to mark as successful at once (with --workers)',
+        ),
+        make_option('--timeout',
+            default=600,
+            type='int',
+            help='Seconds to wait for the outstanding parses at the end of the run (with --workers)',
+        ),
     )
 
     def handle(self, *args, **options):
@@ -70,28 +115,103 @@ class Command(BaseCommand):
             sources = Source.objects.all().requires_processing()
 
         sources.defer('xml')
-        for s in (sources[:limit] if limit else sources):
+        sources = sources[:limit] if limit else sources
+
+        if options['workers'] > 1:
+            self.parse_in_parallel(sources, **options)
+            return
+
+        for s in sources:
         # for s in sources[:limit].iterator():
-            if s.language != 'English':
-                self.stdout.write("Skipping non-English for now...\n") # fails date parsing, hehehe
+            filename = self.start_processing(s)
+            if not filename:
                 continue
-            s.last_processing_attempt = datetime.datetime.now().date()
-            s.save()
             try:
-                try:
-                    filename = s.file()
-                except SourceUrlCouldNotBeRetrieved as e:
-                    s.is404 = True
-                    s.save()
-                    raise e
-                obj = ZAHansardParser.parse(filename)
-                xml = etree.tostring(obj.akomaNtoso)
+                parse_to_xml(filename)
                 # s.xml = xml # we really don't need this
                 s.last_processing_success = datetime.datetime.now().date()
-
-                open('%s.xml' % filename, 'w').write(xml)
                 s.save()
                 self.stdout.write( "Processed %s (%d)\n" % (s.document_name, s.document_number) )
             except Exception as e:
                 # raise CommandError("Failed to run parsing: %s" % str(e))
                 self.stderr.write("WARN: Failed to run parsing: %s" % str(e))
+
+    def start_processing(self, s):
+        """
+        Mark the source as attempted and make sure its file is in the cache.
+
+        Returns the cached filename, or None if the source should be skipped.
+        The attempt is saved before any parsing happens, so a source whose
+        parse never completes is left for --retry to pick up.
+        """
+        if s.language != 'English':
+            self.stdout.write("Skipping non-English for now...\n") # fails date parsing, hehehe
+            return None
+        s.last_processing_attempt = datetime.datetime.now().date()
+        s.save()
+        try:
+            return s.file()
+        except SourceUrlCouldNotBeRetrieved as e:
+            s.is404 = True
+            s.save()
+            self.stderr.write("WARN: Failed to run parsing: %s" % str(e))
+        except Exception as e:
+            self.stderr.write("WARN: Failed to run parsing: %s" % str(e))
+
+    def parse_in_parallel(self, sources, **options):
+        # Download everything that isn't cached yet concurrently first, so
+        # that start_processing doesn't have to fetch them one at a time.
+        prefetch_sources(
+            [s for s in sources if s.language == 'English'],
+            downloader=SourceDownloader(workers=options['workers']),
+            log=lambda message: self.stderr.write('WARN: %s\n' % message))
+
+        pool = process_pool(options['workers'])
+
+        pending = []
+        succeeded = []
+
+        def collect(block):
+            # --timeout is for all the outstanding parses together, not
+            # for each of them.
+            deadline = time.time() + options['timeout']
+            for job in list(pending):
+                (s, result) = job
+                if block:
+                    result.wait(max(0, deadline - time.time()))
+                if not result.ready():
+                    continue
+                pending.remove(job)
+
+                error = result.get()
+                if error:
+                    self.stderr.write("WARN: Failed to run parsing: %s" % error)
+                else:
+                    succeeded.append(s)
+                    self.stdout.write( "Processed %s (%d)\n" % (s.document_name, s.document_number) )
+
+            if len(succeeded) >= options['batch_size'] or block:
+                self.mark_succeeded(succeeded)
+                del succeeded[:]
+
+        try:
+            for s in sources:
+                filename = self.start_processing(s)
+                if filename:
+                    pending.append(
+                        (s, pool.apply_async(parse_worker, (filename,))))
+                collect(block=False)
+            collect(block=True)
+        finally:
+            # Anything still pending has hung or lost its worker. Those
+            # sources keep their attempt but no success, so can be retried.
+            for (s, result) in pending:
+                self.stderr.write("WARN: Gave up waiting to parse %s (%d)\n" % (s.document_name, s.document_number))
+            pool.terminate()
+            pool.join()
+
+    def mark_succeeded(self, sources):
+        if not sources:
+            return
+        Source.objects.filter(id__in=[s.id for s in sources]).update(
+            last_processing_success=datetime.datetime.now().date())
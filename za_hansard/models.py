@@ -1,13 +1,15 @@
 import os, sys
 import re
-import httplib2
 import calendar
 
-from django.db import models
+from django.db import connection, models, transaction
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 from speeches.models import Section
 
+from za_hansard import fetch
+from za_hansard.conversion_cache import write_atomically
+
 
 # check that the cache is setup and the directory exists
 for setting_name in ('HANSARD_CACHE',
@@ -21,6 +23,9 @@ for setting_name in ('HANSARD_CACHE',
     except AttributeError:
         raise ImproperlyConfigured("Could not find {0} setting - please set it".format(setting_name))
 
+# Source urls are relative to this
+SOURCE_URL_BASE = 'http://www.parliament.gov.za/live/'
+
 # EXCEPTIONS
 
 class SourceUrlCouldNotBeRetrieved(Exception):
@@ -29,6 +34,47 @@ class SourceUrlCouldNotBeRetrieved(Exception):
 class SourceCouldNotParseTimeString(Exception):
     pass
 
+# HELPERS
+
+def bulk_update(model, field_name, values, batch_size=500):
+    """
+    Set field_name on the model's rows from values, a dict mapping primary
+    keys to the new value for that row, with one UPDATE per batch.
+
+    (Django 1.4 has no way to set different values on different rows in one
+    query, so this builds a CASE expression by hand.)
+    """
+    if not values:
+        return
+
+    field = model._meta.get_field(field_name)
+    pk_column = connection.ops.quote_name(model._meta.pk.column)
+    sql_template = 'UPDATE %s SET %s = CAST(CASE %s %%s END AS %s) WHERE %s IN (%%s)' % (
+        connection.ops.quote_name(model._meta.db_table),
+        connection.ops.quote_name(field.column),
+        pk_column,
+        field.db_type(connection),
+        pk_column,
+        )
+
+    items = values.items()
+    cursor = connection.cursor()
+    for i in range(0, len(items), batch_size):
+        batch = items[i:i + batch_size]
+        params = []
+        for (pk, value) in batch:
+            params.extend([pk, field.get_db_prep_save(value, connection=connection)])
+        params.extend(pk for (pk, _) in batch)
+        cursor.execute(
+            sql_template % (
+                ' '.join(['WHEN %s THEN %s'] * len(batch)),
+                ', '.join(['%s'] * len(batch))),
+            params)
+
+    # Raw queries aren't committed (or marked as needing a commit, inside a
+    # managed transaction) by themselves.
+    transaction.commit_unless_managed()
+
 
 class SourceQuerySet(models.query.QuerySet):
     def requires_processing(self):
@@ -110,18 +156,18 @@ class Source(models.Model):
             return cache_file_path
 
         # If not fetch the file, save to cache and then return fh
-        h = httplib2.Http()
-        url = 'http://www.parliament.gov.za/live/' + self.url
+        url = self.download_url()
 
         def request_url(url):
             if debug:
                 print >> sys.stderr, 'Requesting %s' % url
-            (response, content) = h.request(url)
-            if response.status != 200:
-                raise SourceUrlCouldNotBeRetrieved("status code: %s, url: %s" % (response.status, self.url) )
+            try:
+                response = fetch.get(url)
+            except fetch.FetchError as e:
+                raise SourceUrlCouldNotBeRetrieved("status code: %s, url: %s" % (e.status, self.url) )
             self.is404 = False
             self.save()
-            return (response, content)
+            return (response, response.content)
 
         try:
             (response, content) = request_url(url)
@@ -138,11 +184,13 @@ class Source(models.Model):
 
         if not content:
             raise SourceUrlCouldNotBeRetrieved("WTF?")
-        with open(cache_file_path, "w") as new_cache_file:
-            new_cache_file.write(content)
+        write_atomically(cache_file_path, content)
 
         return cache_file_path
 
+    def download_url(self):
+        return SOURCE_URL_BASE + self.url
+
     @property
     def section_parent_titles(self):
         return [
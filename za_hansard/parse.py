@@ -1,6 +1,7 @@
 import re
 import subprocess
 import string
+import tempfile
 
 import sys, os
 
@@ -9,11 +10,21 @@ from datetime import datetime
 from lxml import etree
 from lxml import objectify
 
+from django.conf import settings
 from django.template.defaultfilters import slugify
 
+from za_hansard import conversion_cache
+
+# Every byte that cleanLine strips out, for use with str.translate
+unprintable = ''.join(c for c in map(chr, range(256)) if c not in string.printable)
+
+whitespace_re = re.compile(r'\s+')
+
 def cleanLine(line):
     line = line.rstrip(' _\n')
     # NB: string.printable won't filter unicode correctly...
+    if isinstance(line, str):
+        return line.translate(None, unprintable)
     line = filter(lambda x: x in string.printable, line)
     return line
 
@@ -48,16 +59,15 @@ class SingleLineParslet(Parslet):
 class ParaParslet(Parslet):
     @classmethod
     def _handle_match(cls, parser, p):
-        jp = re.sub(
-                r'\s+',
-                ' ',
-                ' '.join(p))
+        jp = whitespace_re.sub(' ', ' '.join(p))
         return cls.match(parser, jp)
 
 class DateParslet(SingleLineParslet):
     date = None
     date_xml = None
 
+    date_re = re.compile(r'(\d+)[ ,]+(\w+)[ ,]+(\d+)$')
+
     def __init__(self, **kwargs):
         self.date     = kwargs.pop('date')
         self.date_xml = kwargs.pop('date_xml')
@@ -67,7 +77,7 @@ class DateParslet(SingleLineParslet):
         if parser.hasDate:
             return None
 
-        match = re.compile(r'(\d+)[ ,]+(\w+)[ ,]+(\d+)$').search(line)
+        match = cls.date_re.search(line)
         if not match:
             # we are assuming that *every* document has a date as first
             # thing, and throw an exception instead of simply returning
@@ -108,6 +118,10 @@ class DateParslet(SingleLineParslet):
 
 class TitleParslet(ParaParslet):
 
+    see_col_re = re.compile('[ -]+see col[ 0.]*')
+    lower_re = re.compile(r'[a-z]')
+    upper_re = re.compile(r'[A-Z]')
+
     @classmethod
     def match(cls, parser, p):
 
@@ -116,12 +130,12 @@ class TitleParslet(ParaParslet):
         #    have no lower-case [a-z]
         #
         # we pre-process to remove "see col 0"
+        # (p has already had its whitespace normalised)
 
-        line = re.sub('\s+', ' ', p)
-        line = re.sub('[ -]+see col[ 0.]*', ' ', p)
-        if re.search(r'[a-z]', line):
+        line = cls.see_col_re.sub(' ', p)
+        if cls.lower_re.search(line):
             return None
-        if not re.search(r'[A-Z]', line):
+        if not cls.upper_re.search(line):
             return None
         return { 'text': line }
 
@@ -136,14 +150,17 @@ class TitleParslet(ParaParslet):
 # (we assume)
 class ParensParslet(SingleLineParslet):
 
+    parens_re = re.compile(r'\s*\([^()]+\)\.?$')
+    possessive_re = re.compile(r'(\(?:Member|Minister)s (.*\)\.?)')
+
     @classmethod
     def match(cls, parser, line):
-        if re.match(r'\s*\([^()]+\)\.?$', line):
+        if cls.parens_re.match(line):
             line = line.strip()
             # Transform, for example:  
             #    '(Members Statement)'  -> '(Member's Statement)'
             #    '(Ministers Response)' -> '(Minister's Response)'
-            line = re.sub( r'(\(?:Member|Minister)s (.*\)\.?)', '\g<1>\'s \g<2>', line )
+            line = cls.possessive_re.sub( '\g<1>\'s \g<2>', line )
             return { 'text': line }
         return None
 
@@ -167,6 +184,8 @@ class AssembledParslet(ParaParslet):
     time = None
     time_iso = None
 
+    assembled_re = re.compile(r'^(.*(?:assembled|met)(?: in .*)? at )(\d+:\d+)\.?$')
+
     def __init__(self, **kwargs):
         self.assembled = kwargs.pop('assembled')
         self.time = kwargs.pop('time')
@@ -177,7 +196,7 @@ class AssembledParslet(ParaParslet):
         if parser.hasAssembled:
             return None
 
-        ret = re.search(r'^(.*(?:assembled|met)(?: in .*)? at )(\d+:\d+)\.?$', p)
+        ret = cls.assembled_re.search(p)
         if ret:
             groups = ret.groups()
             time = datetime.strptime(groups[1], '%H:%M').time()
@@ -209,6 +228,8 @@ class AroseParslet(ParaParslet):
     time = None
     time_iso = None
 
+    arose_re = re.compile(r'^(.*(?:rose|adjourned) at )(\d+:\d+)\.?$')
+
     def __init__(self, **kwargs):
         self.arose = kwargs.pop('arose')
         self.time = kwargs.pop('time')
@@ -219,7 +240,7 @@ class AroseParslet(ParaParslet):
         if parser.hasArisen:
             return None
 
-        ret = re.search(r'^(.*(?:rose|adjourned) at )(\d+:\d+)\.?$', p)
+        ret = cls.arose_re.search(p)
         if ret:
             groups = ret.groups()
             time = datetime.strptime(groups[1], '%H:%M').time()
@@ -246,12 +267,14 @@ class AroseParslet(ParaParslet):
 
 class PrayersParslet(ParaParslet):
 
+    prayers_re = re.compile(r'^(.* prayers or meditation.)$')
+
     @classmethod
     def match(cls, parser, p):
         if parser.hasPrayers:
             return None
 
-        if re.search(r'^(.* prayers or meditation.)$', p):
+        if cls.prayers_re.search(p):
             return { 'text': p }
 
     def output(self, parser, E):
@@ -269,6 +292,7 @@ class SpeechParslet(ParaParslet):
 
     # class member
     name_regexp = r'((?:[A-Z][a-z]+ )[A-Z -]+(?: \((?:\w|\s)+\))?):\s*(.*)'
+    name_re = re.compile(name_regexp)
 
     def __init__(self, **kwargs):
         self.name = kwargs.pop('name')
@@ -277,7 +301,7 @@ class SpeechParslet(ParaParslet):
 
     @classmethod
     def match(cls, parser, p):
-        ret = re.match(cls.name_regexp, p)
+        ret = cls.name_re.match(p)
         if ret:
             (name, speech) = ret.groups()
             id = parser.getOrCreateSpeaker(name) # TODO match with popit here
@@ -316,6 +340,42 @@ class ContinuationParslet(ParaParslet):
             tag = 'p'
             parser.current.append( E(tag, self.text.lstrip() ) )
 
+class ParsletClassifier(object):
+    """
+    Decide which Parslet a paragraph is.
+
+    The Parslet classes are tried in order and the first to match wins, as
+    with calling each class's handle_match in turn.  The difference is that
+    a paragraph's lines are only joined and whitespace normalised once,
+    however many ParaParslets have to look at it.
+    """
+
+    def __init__(self, classes):
+        self.matchers = [
+            (issubclass(cls, SingleLineParslet), cls.match, cls)
+            for cls in classes]
+
+    def classify(self, parser, p):
+        jp = None
+        for (single_line, match, cls) in self.matchers:
+            if single_line:
+                if len(p) != 1:
+                    continue
+                ret = match(parser, p[0])
+            else:
+                if jp is None:
+                    jp = whitespace_re.sub(' ', ' '.join(p))
+                ret = match(parser, jp)
+            if ret:
+                return cls(**ret)
+
+# Regexps used by ZAHansardParser.parse to break lines into paragraphs
+lone_parens_re = re.compile(r'\s*\([^)]+\)$')
+translation_re = re.compile(r'\s*\([Tt]ranslation')
+caps_start_re = re.compile(r'\s*[A-Z]+')
+lower_re = re.compile(r'[a-z]')
+numbered_re = re.compile(r'^\s*\d+\.')
+
 class ZAHansardParser(object):
 
     E = objectify.ElementMaker(
@@ -324,6 +384,17 @@ class ZAHansardParser(object):
             nsmap={None : "http://docs.oasis-open.org/legaldocml/ns/akn/3.0/CSD03"},
             )
 
+    classifier = ParsletClassifier([
+            DateParslet,
+            TitleParslet,
+            ParensParslet,
+            AssembledParslet,
+            AroseParslet,
+            PrayersParslet,
+            SpeechParslet,
+            ContinuationParslet,
+            ])
+
     def __init__(self):
         E = self.E
         self.akomaNtoso = E.akomaNtoso(
@@ -347,41 +418,97 @@ class ZAHansardParser(object):
 
     @classmethod
     def parse(cls, document_path):
+        return cls.parse_lines(cls.antiword_lines(document_path))
+
+    @classmethod
+    def parse_to_file(cls, document_path, output):
+        """
+        Parse the document, writing its XML to the file object output as
+        the parse goes along.
+
+        The XML is the same as etree.tostring(parser.akomaNtoso) would give
+        after a normal parse, but the returned parser's akomaNtoso only has
+        whatever was still being worked on when the parse finished.
+        """
+        return cls.parse_lines(cls.antiword_lines(document_path), output=output)
+
+    @classmethod
+    def antiword_lines(cls, document_path):
+        """
+        Convert the Word document with antiword, generating its lines as
+        antiword produces them.
+
+        The conversion is cached in HANSARD_CACHE, see conversion_cache.
+        """
+
+        def convert_lines():
+            # oddly, antiword gives better results (punctuation, spaces around
+            # dates/numbers) under a C locale, but we will be running under utf8.
+            my_env = os.environ.copy()
+            my_env['LC_ALL'] = 'C'
+
+            # antiword's complaints go to a file rather than a pipe, so that
+            # it can't block on them while we're still reading its output.
+            errors = tempfile.TemporaryFile()
+            antiword = subprocess.Popen(
+                    ['antiword', document_path],
+                    stdout=subprocess.PIPE,
+                    stderr=errors,
+                    env=my_env)
+            try:
+                for line in iter(antiword.stdout.readline, b''):
+                    yield line
+
+                if antiword.wait():
+                    # e.g. not 0 (success) so presumably an error
+                    errors.seek(0)
+                    raise ConversionException("Could not convert %s (%s)" % (document_path, errors.read().rstrip()))
+            finally:
+                # If we stopped reading early, don't leave antiword behind.
+                if antiword.poll() is None:
+                    antiword.kill()
+                    antiword.wait()
+                antiword.stdout.close()
+                errors.close()
+
+        with open(document_path, 'rb') as document:
+            data = document.read()
+
+        return conversion_cache.cached_lines(
+            settings.HANSARD_CACHE, ['antiword', 'LC_ALL=C'], data, convert_lines)
 
-        # oddly, antiword gives better results (punctuation, spaces around
-        # dates/numbers) under a C locale, but we will be running under utf8.
-        my_env = os.environ.copy()
-        my_env['LC_ALL'] = 'C'
+    @classmethod
+    def parse_lines(cls, lines, output=None):
+        """
+        Parse the lines of antiword output for a Hansard, streaming the XML
+        to output (a file object) if it's given.
 
-        antiword = subprocess.Popen(
-                ['antiword', document_path],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                env=my_env)
-        (stdoutdata, stderrdata) = antiword.communicate()
-        if antiword.returncode:
-            # e.g. not 0 (success) or None (still running) so presumably an error
-            raise ConversionException("Could not convert %s (%s)" % (document_path, stdoutdata.rstrip()))
+        When streaming, the XML tree only holds the part of the document
+        still being built, but the paragraphs are all classified first (see
+        below), so memory use still grows with the document.
+        """
 
-        # lines = imap(cleanLine, iter(antiword.stdout.readline, b''))
-        lines = imap(cleanLine, iter(stdoutdata.split('\n')))
+        # lines may be a generator from antiword_lines, in which case the
+        # paragraphs are broken up and matched below while antiword is
+        # still converting the rest of the document.
+        lines = imap(cleanLine, iter(lines))
 
         def make_break_paras(obj):
-            name_regexp = SpeechParslet.name_regexp
+            name_re = SpeechParslet.name_re
 
             def break_paras(line):
                 # FIRST we handle exceptions:
                 # NB: these lines should probably actually be included with their respective heading
                 # if re.match( r'\s*\((Member\'?s? [sS]tatement|Minister\'s? [Rr]esponse\))', line ):
-                if re.match( r'\s*\([^)]+\)$', line ) and not re.match( r'\s*\([Tt]ranslation', line ):
+                if lone_parens_re.match( line ) and not translation_re.match( line ):
                     return line # distinct from True or False, but a True value
 
                 # An ALL CAPS heading might be on the first line of a new page and therefore not be separated
                 # by blank lines
-                if re.match( r'\s*[A-Z]+', line ) and not re.search( r'[a-z]', line ):
+                if caps_start_re.match( line ) and not lower_re.search( line ):
                     return "TITLE"
 
-                if re.match( name_regexp, line ):
+                if name_re.match( line ):
                     # we update our True value to make sure that badly chunked paragraphs still get separated
                     # out into speakers!
                     obj.increment_chunking()
@@ -444,56 +571,47 @@ class ZAHansardParser(object):
                         ),
                     source='#mysociety'))
 
-        classes = [
-                DateParslet,
-                TitleParslet,
-                ParensParslet,
-                AssembledParslet,
-                AroseParslet,
-                PrayersParslet,
-                SpeechParslet,
-                ContinuationParslet,
-                ]
-
-        def match(p):
-            #try:
-                m = ifilter(
-                        lambda x: x != None,
-                        imap(
-                            lambda cls: cls.handle_match(obj, p),
-                            classes)
-                        ).next()
-                return m
-            #except Exception as e:
-                #raise e
-                #raise Exception("Parsing failed at '%s'" % p[:50])
-
-        nodes = [match(list(p)) for p in paras]
+        # Every paragraph is classified before any is output, so this list
+        # of Parslets (holding all the document's text) is as big as the
+        # document. It can't be streamed: classifying a speech adds its
+        # speaker to the references in the meta, which is written before
+        # the body, and the Parslets that only match once check flags that
+        # their output sets. It's the tree, and the XML, that are streamed.
+        classify = cls.classifier.classify
+        nodes = [classify(obj, list(p)) for p in paras]
 
         def transformParens(nodes):
-            result = []
-            a = nodes[0]
-            for b in nodes[1:]:
+            # Generates the nodes with one node of lookahead, rather than
+            # building a second copy of the list.
+            nodes = iter(nodes)
+            a = b = next(nodes)
+            for b in nodes:
                 if ((type(b).__name__ == 'ParensParslet') and
                     (type(a).__name__ == 'ContinuationParslet') and
-                    (not re.compile('^\s*\d+\.').match(a.text))):
+                    (not numbered_re.match(a.text))):
                     if False:
                         print >> sys.stderr, '   A %s' % a.text
                         print >> sys.stderr, '   B %s' % b.text
                         print >> sys.stderr
-                    result.append( TitleParslet(text=a.text) )
+                    yield TitleParslet(text=a.text)
                 else:
                     # TODO: perhaps should also rewrite the Parens into a ContinuationParslet?
-                    result.append( a )
+                    yield a
                 a = b
-            result.append(b)
-            return result
+            yield b
 
         nodes = transformParens(nodes)
         # TODO transformation step here! (i.e. the whole point of this refactor)
 
+        writer = AkomaNtosoWriter(obj, output) if output is not None else None
+
         for n in nodes:
             n.output(obj, obj.E)
+            if writer:
+                writer.flush()
+
+        if writer:
+            writer.close()
 
         return obj
 
@@ -536,3 +654,113 @@ class ZAHansardParser(object):
                     showAs=name,
                     href='http://dummy/popit/path/%s' % slug ))
         return slug
+
+def write_element(xf, element):
+    """
+    Write element, its descendants and its tail with the xmlfile xf.
+
+    xmlfile's own write() redeclares the namespace on every element it is
+    given, so elements are written one at a time to get exactly the bytes
+    that tostring() would give for the whole tree.
+    """
+    if element.text is None and next(element.iterchildren(), None) is None:
+        # Written without a namespace so that it comes out as <tag/>
+        # without a namespace declaration.
+        xf.write(etree.Element(etree.QName(element).localname, dict(element.attrib)))
+    else:
+        with xf.element(element.tag, dict(element.attrib)):
+            if element.text:
+                xf.write(element.text)
+            for child in element.iterchildren():
+                write_element(xf, child)
+    if element.tail:
+        xf.write(element.tail)
+
+class AkomaNtosoWriter(object):
+    """
+    Write a ZAHansardParser's Akoma Ntoso XML to a file while it is built.
+
+    After each Parslet is output, every element that can no longer change
+    is written with lxml's xmlfile and removed from the parser's tree. The
+    elements that can still change are the current element, its ancestors
+    (which get new children, and whose start tags are written as soon as
+    they are reached), and the heading of the current section (which
+    ParensParslet can add to).
+
+    Nothing is written until the title and date have been output, as they
+    set attributes on the debate and the FRBR elements in the meta.
+    """
+
+    container_tags = ('debate', 'debateBody', 'debateSection')
+
+    def __init__(self, parser, output):
+        self.parser = parser
+        self.output = output
+        self.xmlfile = None
+        self.opened = [] # pairs of element and xmlfile.element context
+
+    def flush(self):
+        parser = self.parser
+        if not (parser.hasTitle and parser.date):
+            return
+
+        current = parser.current
+        live = [current] + list(current.iterancestors())
+        if etree.QName(current).localname == 'debateSection':
+            live.append(current.heading)
+
+        self.write_finished(live)
+
+    def close(self):
+        self.write_finished([])
+
+    def write_finished(self, live):
+        is_live = lambda element: any(element is l for l in live)
+
+        if self.xmlfile is None:
+            self.xmlfile = etree.xmlfile(self.output)
+            self.xf = self.xmlfile.__enter__()
+            self.open_element(self.parser.akomaNtoso)
+
+        # Finish off any open elements which can no longer change.
+        while self.opened and not is_live(self.opened[-1][0]):
+            self.close_element()
+
+        # Then write out the finished children of the innermost open
+        # element, descending into the next element which is still live.
+        while self.opened:
+            parent = self.opened[-1][0]
+            for child in parent.iterchildren():
+                if is_live(child):
+                    if etree.QName(child).localname in self.container_tags:
+                        self.open_element(child)
+                        break
+                    return
+                write_element(self.xf, child)
+                parent.remove(child)
+            else:
+                return
+
+        self.xmlfile.__exit__(None, None, None)
+
+    def open_element(self, element):
+        context = self.xf.element(
+            element.tag, dict(element.attrib),
+            nsmap=element.nsmap if element.getparent() is None else None)
+        context.__enter__()
+        if element.text:
+            self.xf.write(element.text)
+        self.opened.append((element, context))
+
+    def close_element(self):
+        (element, context) = self.opened.pop()
+        for child in element.iterchildren():
+            write_element(self.xf, child)
+            element.remove(child)
+        context.__exit__(None, None, None)
+        if element.tail:
+            self.xf.write(element.tail)
+
+        parent = element.getparent()
+        if parent is not None:
+            parent.remove(element)
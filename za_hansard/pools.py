@@ -0,0 +1,20 @@
+"""
+Process pools for the commands that spread work over several processes.
+"""
+
+import multiprocessing
+
+from django.db import connection
+
+def process_pool(workers):
+    """
+    Return a multiprocessing.Pool of workers processes.
+
+    Forked processes would inherit our database connection, and anything
+    they did with it would be mixed up with what we do, so it's closed
+    first; Django opens a new one when it is next needed. Make the pool
+    before starting any threads, as forking with threads running is asking
+    for trouble.
+    """
+    connection.close()
+    return multiprocessing.Pool(workers)
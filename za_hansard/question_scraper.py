@@ -4,19 +4,23 @@ import hashlib
 import os
 import sys
 import re
-import requests
+import shutil
 import subprocess
 import tempfile
 import warnings
 import datetime
 import lxml.etree
 
+from StringIO import StringIO
+
 import parslepy
 
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
+from django.db import transaction
 
 from za_hansard.models import Question, QuestionPaper
+from za_hansard import conversion_cache, fetch
 
 # from https://github.com/scraperwiki/scraperwiki-python/blob/a96582f6c20cc1897f410d522e2a5bf37d301220/scraperwiki/utils.py#L38-L54
 # Copied rather than included as the scraperwiki __init__.py was having trouble
@@ -26,36 +30,96 @@ def ensure_executable_found(name):
     if not distutils.spawn.find_executable(name):
         raise ImproperlyConfigured("Can't find executable '{0}' which is needed by this code".format(name))
 
+class PdfConversionError(Exception):
+    pass
+
+# Use a memory-backed filesystem for the PDFs we give to pdftohtml, which
+# can't read them from a pipe, if there is one.
+memory_temp_dir = '/dev/shm' if os.access('/dev/shm', os.W_OK) else None
+
+italics_re = re.compile(r'</?i>')
+
+def strip_italics(chunks):
+    r"""
+    Remove <i> and </i> tags from the byte strings in chunks, generating the
+    results. Tags split between chunks are held back until the next chunk.
+
+    >>> ''.join(strip_italics(['<b>a<', 'i>b</b', '> <', '/i> <', '/', 'i', '><text>']))
+    '<b>ab</b>  <text>'
+    """
+    held = ''
+    for chunk in chunks:
+        chunk = held + chunk
+        start = chunk.rfind('<')
+        # Anything from the last '<' that could still become '</i>'
+        if start != -1 and len(chunk) - start < 4 and '>' not in chunk[start:]:
+            (chunk, held) = (chunk[:start], chunk[start:])
+        else:
+            held = ''
+        yield italics_re.sub('', chunk)
+    yield italics_re.sub('', held)
+
 ensure_executable_found("pdftohtml")
 def pdftoxml(pdfdata):
-    """converts pdf file to xml file"""
-    pdffout = tempfile.NamedTemporaryFile(suffix='.pdf')
-    pdffout.write(pdfdata)
-    pdffout.flush()
+    """
+    Convert a PDF (as a byte string) to pdftohtml's XML.
 
-    xmlin = tempfile.NamedTemporaryFile(mode='r', suffix='.xml')
-    tmpxml = xmlin.name # "temph.xml"
-    cmd = 'pdftohtml -xml -nodrm -zoom 1.5 -enc UTF-8 -noframes "%s" "%s"' % (pdffout.name, os.path.splitext(tmpxml)[0])
-    cmd = cmd + " >/dev/null 2>&1" # can't turn off output, so throw away even stderr yeuch
-    os.system(cmd)
+    Raises PdfConversionError if pdftohtml fails.
+    """
+    pdftohtml_args = ['pdftohtml', '-xml', '-nodrm', '-zoom', '1.5', '-enc', 'UTF-8', '-noframes', '-stdout']
+
+    def convert():
+        # pdftohtml writes any images it finds into the working directory,
+        # so give it one of its own to do that in.
+        tempdir = tempfile.mkdtemp(dir=memory_temp_dir)
+        try:
+            with open(os.path.join(tempdir, 'input.pdf'), 'wb') as pdffile:
+                pdffile.write(pdfdata)
+
+            with tempfile.TemporaryFile() as stderr:
+                process = subprocess.Popen(
+                    pdftohtml_args + ['input.pdf'],
+                    cwd=tempdir,
+                    stdout=subprocess.PIPE,
+                    stderr=stderr,
+                    )
 
-    pdffout.close()
-    #xmlfin = open(tmpxml)
-    xmldata = xmlin.read()
-    xmlin.close()
+                # pdftohtml version 0.18.4 occasionally produces bad markup of the
+                # form <b>...<i>...</b> </i>, which can't be parsed. Since we don't
+                # actually need <i> tags, we may as well get rid of them all as
+                # the output comes in, which will fix this. Note that we're
+                # working with a byte string version of utf-8 encoded data here.
+                xmldata = ''.join(strip_italics(
+                    iter(lambda: process.stdout.read(65536), '')))
 
-    # pdftohtml version 0.18.4 occasionally produces bad markup of the form <b>...<i>...</b> </i>
-    # Since ee don't actually need <i> tags, we may as well get rid of them all now, which will fix this.
-    # Note that we're working with a byte string version of utf-8 encoded data here.
+                if process.wait():
+                    stderr.seek(0)
+                    raise PdfConversionError(
+                        'pdftohtml exited with status %d: %s'
+                        % (process.returncode, stderr.read().strip()))
+        finally:
+            shutil.rmtree(tempdir)
 
-    xmldata = re.sub(r'</?i>', '', xmldata)
+        return xmldata
 
-    return xmldata
+    # The cached output has already had its <i> tags removed.
+    return conversion_cache.cached_output(
+        settings.QUESTION_CACHE, pdftohtml_args, pdfdata, convert)
 
 
 ensure_executable_found("antiword")
 def extract_answer_text_from_word_document(filename):
-    text = check_output_wrapper(['antiword', filename]).decode('unicode-escape')
+    with open(filename, 'rb') as document:
+        data = document.read()
+
+    output = conversion_cache.cached_output(
+        settings.ANSWER_CACHE, ['antiword'], data,
+        lambda: check_output_wrapper(['antiword', filename]))
+
+    return answer_text_from_antiword_output(output)
+
+def answer_text_from_antiword_output(output):
+    text = output.decode('unicode-escape')
 
     # strip out lines that are just '________'
     bar_regex = re.compile(r'^_+$', re.MULTILINE)
@@ -106,7 +170,7 @@ class BaseDetailIterator(object):
 
     def url_get(self, url):
         """Super simple method to retrieve url and return content. Intended to be easily mocked in tests"""
-        return requests.get(url).text
+        return fetch.get(url, conditional=True).text
 
 class QuestionDetailIterator(BaseDetailIterator):
 
@@ -314,26 +378,110 @@ def remove_headers_from_page(page):
     >>> page_header_regex.match(u' Friday, 9 October 2009 INTERNAL QUESTION PAPER: NATIONAL ASSEMBLY NO 20 - 2009 533') is not None
     True
 
+    Returns the number of text elements removed.
     """
 
-    accumulated = ''
-
     # 10 text elements should be enough to catch all
     # the headers, and few enough to prevent us interfering
     # with more than one question if it all goes wrong.
-    for text_el in page.xpath('text[position()<=10]'):
-        accumulated += re.match(ur'(?s)<text.*?>(.*?)</text>', lxml.etree.tostring(text_el, encoding='unicode')).group(1)
-        accumulated = re.sub(ur'(?u)<i>(.*?)</i>', ur'\1', accumulated)
-        accumulated = re.sub(ur'(?u)</i>(.*?)<i>', ur'\1', accumulated)
-        accumulated = re.sub(ur'(?u)(\s+)', ur' ', accumulated)
+    text_els = page.xpath('text[position()<=10]')
 
+    for count, accumulated in enumerate(accumulate_header_text(text_els), 1):
         if page_header_regex.match(accumulated):
-            for to_remove in text_el.itersiblings(preceding=True):
-                page.remove(to_remove)
+            remove_leading_text(page, text_els[count - 1])
+            return count
+
+    return 0
+
+def remove_headers(root):
+    """Remove the headers from every page of a question paper.
+
+    This has the same effect as remove_headers_from_page on each page, but
+    learns which 'top' positions the headers are at from the pages it has
+    done. For a page starting with text elements at those positions, it
+    only has to check that the header ends at the last of them, rather
+    than testing after every element. Pages which don't fit fall back to
+    remove_headers_from_page.
+
+    Returns a dictionary of statistics about what was removed: the number
+    of pages, of pages with headers, of those whose headers were found by
+    position and by searching, and of text elements removed.
+    """
+    stats = {'pages': 0, 'pages_with_headers': 0, 'pages_by_position': 0, 'pages_by_search': 0, 'text_removed': 0}
+    header_tops = set()
+
+    for page in root.iter('page'):
+        stats['pages'] += 1
+        text_els = page.xpath('text[position()<=10]')
+
+        count = 0
+        while count < len(text_els) and text_els[count].get('top') in header_tops:
+            count += 1
+
+        if count:
+            bits = [inner_xml(el) for el in text_els[:count]]
+            if any('<i>' in bit or '</i>' in bit for bit in bits):
+                accumulated = list(accumulate_header_text(text_els[:count]))
+                (previous, last) = ([u''] + accumulated)[-2:]
+            else:
+                # Without any italics, tidying up the text is just collapsing
+                # whitespace, which can be done in one go.
+                previous = header_whitespace_re.sub(u' ', u''.join(bits[:-1]))
+                last = header_whitespace_re.sub(u' ', u''.join(bits))
+
+            if page_header_regex.match(last) and (count == 1 or not page_header_regex.match(previous)):
+                remove_leading_text(page, text_els[count - 1])
+                stats['pages_by_position'] += 1
+            else:
+                count = 0
 
-            page.remove(text_el)
-            break
+        if not count:
+            count = remove_headers_from_page(page)
+            header_tops.update(el.get('top') for el in text_els[:count])
+            if count:
+                stats['pages_by_search'] += 1
 
+        if count:
+            stats['pages_with_headers'] += 1
+            stats['text_removed'] += count
+
+    return stats
+
+header_italics_re = re.compile(ur'(?u)<i>(.*?)</i>')
+header_unitalics_re = re.compile(ur'(?u)</i>(.*?)<i>')
+header_whitespace_re = re.compile(ur'(?u)(\s+)')
+
+def accumulate_header_text(text_els):
+    """
+    Generate the text of text_els as far as each element, tidied up for
+    matching against page_header_regex.
+    """
+    accumulated = u''
+    for text_el in text_els:
+        accumulated += inner_xml(text_el)
+        accumulated = header_italics_re.sub(ur'\1', accumulated)
+        accumulated = header_unitalics_re.sub(ur'\1', accumulated)
+        accumulated = header_whitespace_re.sub(ur' ', accumulated)
+        yield accumulated
+
+def remove_leading_text(page, text_el):
+    """Remove text_el from page, along with everything before it"""
+    for to_remove in text_el.itersiblings(preceding=True):
+        page.remove(to_remove)
+
+    page.remove(text_el)
+
+
+def inner_xml(el):
+    """
+    Return the XML inside el as unicode, as it would appear in
+    lxml.etree.tostring(el).
+    """
+    text = el.text or u''
+    if text:
+        text = text.replace(u'&', u'&amp;').replace(u'<', u'&lt;').replace(u'>', u'&gt;').replace(u'\r', u'&#13;')
+    return text + u''.join(
+        lxml.etree.tostring(child, encoding='unicode') for child in el)
 
 class QuestionPaperParser(object):
     def __init__(self, **kwargs):
@@ -347,7 +495,11 @@ class QuestionPaperParser(object):
         if not pdfdata:
             return
 
-        xmldata = self.get_question_xml_from_pdf(pdfdata)
+        try:
+            xmldata = self.get_question_xml_from_pdf(pdfdata)
+        except PdfConversionError as e:
+            sys.stdout.write(' SKIPPING - {0}\n'.format(e))
+            return
 
         if not xmldata:
             sys.stdout.write(' SKIPPING - Got no XML data\n')
@@ -360,7 +512,17 @@ class QuestionPaperParser(object):
         self.create_questions_from_xml(xmldata, url)
 
     def get_question_pdf_from_url(self, url):
-        # FIXME - Cope with an HTTP error, etc here.
+        try:
+            return self.download_question_pdf(url)
+        except fetch.FetchError:
+            sys.stdout.write(' SKIPPING - Bad response\n')
+            return
+
+    def download_question_pdf(self, url):
+        """
+        Return the PDF at url, from the cache if we have it. Raises
+        za_hansard.fetch.FetchError if it can't be downloaded.
+        """
         contents_filename = os.path.join(
             settings.QUESTION_CACHE,
             hashlib.md5(url).hexdigest(),
@@ -368,19 +530,10 @@ class QuestionPaperParser(object):
 
         if os.path.exists(contents_filename):
             with open(contents_filename) as f:
-                contents = f.read()
-        else:
-            response = requests.get(url)
-
-            if response.status_code == requests.codes.ok:
-                contents = response.content
-            else:
-                sys.stdout.write(' SKIPPING - Bad response\n')
-                return
-
-            with open(contents_filename, 'wb') as f:
-                f.write(contents)
+                return f.read()
 
+        contents = fetch.get(url).content
+        conversion_cache.write_atomically(contents_filename, contents)
         return contents
 
     def get_question_xml_from_pdf(self, pdfdata):
@@ -452,12 +605,19 @@ class QuestionPaperParser(object):
             # on other question papers.
             return
 
+        return question_paper
+
+    def save_question_paper(self, question_paper):
+        """
+        Save the question paper from get_question_paper, returning it, unless
+        we already have the same paper.
+        """
         try:
             old_qp = QuestionPaper.objects.get(
                 year=question_paper.year,
                 issue_number=question_paper.issue_number,
                 house=question_paper.house,
-                parliament_number=parliament_number,
+                parliament_number=question_paper.parliament_number,
                 )
             # FIXME - We need to be able to cope with reprints of question papers.
             sys.stdout.write("\nBAILING OUT: Question Paper {0} too similar to\n".format(question_paper.source_url))
@@ -560,66 +720,92 @@ class QuestionPaperParser(object):
 
     def chunkify(self, root):
         """
+        Return the text of the question paper before the first date, and
+        an iterator over pairs of a date and the text for that date.
+
         >>> date_str = ur'<b>FRIDAY, 2 AUGUST 2013 </b>'
         >>> match = QuestionPaperParser.date_re.match(date_str)
         >>> match.groups()
         (u'FRIDAY', u'2', u'AUGUST', u'2013')
 
         """
-        text_bits = [
-            re.match(ur'(?s)<text.*?>(.*?)</text>', lxml.etree.tostring(el, encoding='unicode')).group(1)
-            for el in root.iterfind('.//text')
-            ]
+        chunks = self.iter_chunks(root)
+        intro_chunk = next(chunks)[1]
+
+        return intro_chunk, chunks
 
-        # Let's split text_bits up by dates
+    def iter_chunks(self, root):
+        """
+        Split the text of the question paper up by the dates in it,
+        generating pairs of a date and the text up to the next date (the
+        first of which has the date None).
+        """
         chunk = []
         date = None
+        date_match = None
+
+        for el in root.iter('text'):
+            text_bit = inner_xml(el)
 
-        chunks = []
+            if date_match:
+                date_str = "{day_of_week}, {day} {month} {year}".format(**date_match.groupdict())
+                date = datetime.datetime.strptime(date_str, "%A, %d %B %Y").date()
 
-        while text_bits:
-            text_bit = text_bits.pop(0)
             date_match = self.date_re.match(text_bit)
 
-            if not date_match:
+            if date_match:
+                yield (date, self.clean_chunk(chunk))
+                chunk = []
+            else:
                 chunk.append(text_bit)
 
-            if date_match or not text_bits:
-                text = u''.join(chunk)
+        # A date at the very end has nothing after it.
+        if not date_match:
+            yield (date, self.clean_chunk(chunk))
 
-                # We may as well git rid of bolding or unbolding around whitespace.
-                text = re.sub(ur'</b>(\s*)<b>', ur'\1', text)
-                text = re.sub(ur'<b>(\s*)</b>', ur'\1', text)
+    bold_whitespace_re = re.compile(ur'</b>(\s*)<b>')
+    empty_bold_re = re.compile(ur'<b>(\s*)</b>')
+    whitespace_re = re.compile(r'\s+')
 
-                # Replace all whitespace with single spaces.
-                text = re.sub(r'\s+', ' ', text)
+    def clean_chunk(self, chunk):
+        text = u''.join(chunk)
 
-                # As we're using the </b> to tell us when the intro is over, it would be
-                # helpful if we could always have the colon on the same side of it.
-                text = text.replace('</b>:', ':</b>')
+        # We may as well git rid of bolding or unbolding around whitespace.
+        text = self.bold_whitespace_re.sub(ur'\1', text)
+        text = self.empty_bold_re.sub(ur'\1', text)
 
-                chunks.append((date, text))
+        # Replace all whitespace with single spaces.
+        text = self.whitespace_re.sub(' ', text)
 
-                if text_bits:
-                    chunk = []
-                    date_str = "{day_of_week}, {day} {month} {year}".format(**date_match.groupdict())
-                    date = datetime.datetime.strptime(date_str, "%A, %d %B %Y").date()
+        # As we're using the </b> to tell us when the intro is over, it would be
+        # helpful if we could always have the colon on the same side of it.
+        return text.replace('</b>:', ':</b>')
 
-        intro_chunk = chunks.pop(0)[1]
 
-        return intro_chunk, chunks
+    def create_questions_from_xml(self, xmldata, url):
+        parsed = self.parse_questions_from_xml(xmldata)
 
+        # Bail out if we didn't get a question paper
+        if not parsed:
+            return
 
-    def create_questions_from_xml(self, xmldata, url):
+        self.save_questions(*parsed)
+
+    def parse_questions_from_xml(self, xmldata):
+        """
+        Parse the question paper and its questions out of the XML, without
+        touching the database, so that this can be done in another process.
+
+        Returns a tuple of the (unsaved) question paper, its questions and
+        the number of questions we expected to find, for save_questions. Or
+        None if there is no question paper that we want.
+        """
         # Sanity check on number of questions
         expected_question_count = len(re.findall(r'[NC][OW]\d+E', xmldata))
 
         text = lxml.etree.fromstring(xmldata)
 
-        pages = text.iter('page')
-
-        for page in pages:
-            remove_headers_from_page(page)
+        remove_headers(text)
 
         intro_chunk, chunks = self.chunkify(text)
 
@@ -634,6 +820,20 @@ class QuestionPaperParser(object):
         for date, chunk in chunks:
             questions.extend(self.get_questions_from_chunk(date, chunk))
 
+        return (self.question_paper, questions, expected_question_count)
+
+    def save_questions(self, question_paper, questions, expected_question_count):
+        """Save the results of parse_questions_from_xml"""
+        self.question_paper = self.save_question_paper(question_paper)
+
+        if not self.question_paper:
+            return
+
+        for question in questions:
+            # The paper hadn't been saved when the question was created, so
+            # set it again to pick up its id.
+            question.paper = self.question_paper
+
         sys.stdout.write(' found {0} questions'.format(len(questions)))
 
         if len(questions) != expected_question_count:
@@ -641,7 +841,22 @@ class QuestionPaperParser(object):
 
         sys.stdout.write('\n')
 
-        # Question.objects.bulk_create(questions)
+        # The questions we might clash with, from the database and as we go
+        # along from this paper, by (id_number, house, year) with their
+        # identifier and the date of their paper, and by written_number.
+        houses = set(question.house for question in questions)
+        years = set(question.year for question in questions)
+        existing = Question.objects.filter(house__in=houses, year__in=years)
+
+        existing_by_id_number = dict(
+            ((id_number, house, year), (identifier, date_published))
+            for (id_number, house, year, identifier, date_published)
+            in existing.values_list('id_number', 'house', 'year', 'identifier', 'paper__date_published'))
+        existing_written_numbers = set(
+            existing.filter(written_number__isnull=False)
+            .values_list('written_number', 'house', 'year'))
+
+        new_questions = []
         for question in questions:
             # FIXME - As a temporary fix, let's ignore any questions which aren't for written
             # answer.
@@ -653,38 +868,68 @@ class QuestionPaperParser(object):
             if re.search(r'\[Written Question No', question.intro, re.IGNORECASE):
                 continue
 
-            try:
-                existing_question = Question.objects.get(
-                    id_number=question.id_number,
-                    house=question.house,
-                    year=question.year,
-                )
-                if existing_question.paper.date_published > question.paper.date_published:
+            # Question numbers come out of the regex as strings.
+            id_number_key = (int(question.id_number), question.house, question.year)
+            written_number_key = (int(question.written_number), question.house, question.year)
+
+            if id_number_key in existing_by_id_number:
+                (existing_identifier, existing_date_published) = existing_by_id_number[id_number_key]
+                if existing_date_published > question.paper.date_published:
                     # FIXME - in future real life, these duplicates will be bad.
                     # we need to be able to cope with a revised question or a question
                     # changing from oral to written, etc.
-                    if question.identifier != existing_question.identifier:
-                        sys.stdout.write("IDENTIFIER CHANGE: {0} already exists as {1} - keeping original version\n".format(question.identifier, existing_question.identifier))
+                    if question.identifier != existing_identifier:
+                        sys.stdout.write("IDENTIFIER CHANGE: {0} already exists as {1} - keeping original version\n".format(question.identifier, existing_identifier))
                     else:
                         sys.stdout.write("DUPLICATE: {0} already exists - keeping original version\n".format(question.identifier))
 
                 else:
-                    sys.stdout.write("BAD DUPLICATE: {0} already exists as {1} - keeping OLD VERSION\n".format(question.identifier, existing_question.identifier))
-            except Question.DoesNotExist:
-                if Question.objects.filter(
-                    written_number=question.written_number,
-                    house=question.house,
-                    year=question.year,
-                    ).exists():
-                    sys.stdout.write(
-                        "DUPLICATE written_number {0} {1} {2} - SKIPPING\n"
-                        .format(question.written_number, question.house, question.year)
-                        )
+                    sys.stdout.write("BAD DUPLICATE: {0} already exists as {1} - keeping OLD VERSION\n".format(question.identifier, existing_identifier))
+                continue
 
-                    # Interesting failures here:
-                    # 998 - a typo, should have been 898
-                    # 3641 - number repeated for questions with two identifiers by the same person NW4421E NW4422E
-                    continue
+            if written_number_key in existing_written_numbers:
+                sys.stdout.write(
+                    "DUPLICATE written_number {0} {1} {2} - SKIPPING\n"
+                    .format(question.written_number, question.house, question.year)
+                    )
 
-                question.save()
+                # Interesting failures here:
+                # 998 - a typo, should have been 898
+                # 3641 - number repeated for questions with two identifiers by the same person NW4421E NW4422E
+                continue
+
+            existing_by_id_number[id_number_key] = (question.identifier, question.paper.date_published)
+            existing_written_numbers.add(written_number_key)
+            new_questions.append(question)
+
+        with transaction.commit_on_success():
+            Question.objects.bulk_create(new_questions)
+
+
+def parse_question_paper(detail, pdfdata):
+    """
+    Convert a question paper's PDF and parse its questions, for running in a
+    process pool.
+
+    Returns a tuple of what would have been written to stdout, so that the
+    caller can write it out in order with everything else, and what
+    parse_questions_from_xml returns, to be saved with save_questions.
+    """
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        parser = QuestionPaperParser(**detail)
+        try:
+            xmldata = parser.get_question_xml_from_pdf(pdfdata)
+        except PdfConversionError as e:
+            sys.stdout.write(' SKIPPING - {0}\n'.format(e))
+            return (sys.stdout.getvalue(), None)
+
+        if not xmldata:
+            sys.stdout.write(' SKIPPING - Got no XML data\n')
+            return (sys.stdout.getvalue(), None)
 
+        parsed = parser.parse_questions_from_xml(xmldata)
+        return (sys.stdout.getvalue(), parsed)
+    finally:
+        sys.stdout = stdout
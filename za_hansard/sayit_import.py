@@ -0,0 +1,75 @@
+"""
+Importing documents into SayIt in batches.
+
+Importing each document with its own importer, and saving each imported
+row on its own, spends most of the time on per-document overhead. Here one
+importer (and so its cache of the people it has looked up) is used for
+every document, each batch of documents is imported in one transaction,
+and the rows' sayit_section and last_sayit_import are set with one query
+each per batch.
+"""
+
+from datetime import datetime
+
+from django.db import transaction
+
+from za_hansard.models import bulk_update
+
+def import_documents(importer, model, documents, batch_size=50, log=None):
+    """
+    Import documents, pairs of a row of model and the path of its JSON
+    file, with importer, committing every batch_size documents. The one
+    importer is used for every document, so the people it looks up in
+    PopIt are only looked up once.
+
+    Each document is imported inside a savepoint, so one that fails to
+    import is rolled back on its own; log, if given, is called with a
+    message about it. Returns the sections imported.
+
+    That needs a database backend with savepoints (PostgreSQL). Without
+    them (SQLite, under Django 1.4) rolling back to a savepoint does
+    nothing, and whatever a failed document wrote before it failed is
+    committed with the rest of its batch.
+    """
+    sections = []
+
+    batch = []
+    for document in documents:
+        batch.append(document)
+        if len(batch) >= batch_size:
+            sections.extend(import_batch(importer, model, batch, log))
+            batch = []
+    if batch:
+        sections.extend(import_batch(importer, model, batch, log))
+
+    return sections
+
+def import_batch(importer, model, batch, log):
+    imported = {}
+    sections = []
+
+    with transaction.commit_manually():
+        try:
+            for (row, path) in batch:
+                savepoint = transaction.savepoint()
+                try:
+                    section = importer.import_document(path)
+                except Exception as e:
+                    transaction.savepoint_rollback(savepoint)
+                    if log:
+                        log('failed to import %d: %s' % (row.id, str(e)))
+                    continue
+                transaction.savepoint_commit(savepoint)
+
+                imported[row.id] = section.id
+                sections.append(section)
+
+            bulk_update(model, 'sayit_section', imported)
+            today = datetime.now().date()
+            bulk_update(model, 'last_sayit_import', dict((pk, today) for pk in imported))
+            transaction.commit()
+        except:
+            transaction.rollback()
+            raise
+
+    return sections
@@ -1,10 +1,31 @@
+from contextlib import closing, contextmanager
 from datetime import date, time
+from multiprocessing.pool import ThreadPool
+from StringIO import StringIO
+import threading
 
+from mock import Mock, patch
+import json
+import os
+import shutil
+import tempfile
+
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.core.management import call_command
+from django.utils.unittest import skipUnless
 
+from instances.models import Instance
 from speeches.tests.helpers import create_sections
-from speeches.models import Speech, Tag
+from speeches.models import Section, Speech, Tag
+
+from za_hansard.conversion_cache import write_atomically
+from za_hansard.datejson import JsonLinesWriter, read_json_lines
+from za_hansard.fetch import FetchError
+from za_hansard.management.commands.za_hansard_pmg_scraper import Command as PMGScraperCommand, StopFetchingException
+from za_hansard.models import PMGCommitteeAppearance, PMGCommitteeReport
+from za_hansard.sayit_import import import_documents
 
 
 class OneOffTagSpeechesTests(TestCase):
@@ -55,3 +76,471 @@ class OneOffTagSpeechesTests(TestCase):
         self.assertEqual(Speech.objects.filter(tags=None).count(), 6)
         self.assertEqual(Speech.objects.filter(tags=hansard).count(), 6)
         self.assertEqual(Speech.objects.filter(tags=committee).count(), 6)
+
+
+class PMGScraperTests(TestCase):
+
+    def setUp(self):
+        self.command = PMGScraperCommand()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+        # As handle() would set up.
+        self.command.counter_lock = threading.Lock()
+        self.command.report_lock = threading.Lock()
+        self.command.reports_in_progress = set()
+
+    def test_count(self):
+        def count():
+            for i in range(1000):
+                self.command.count('reportschecked')
+                self.command.count('appearancesadded', 2)
+
+        threads = [threading.Thread(target=count) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.command.reportschecked, 4000)
+        self.assertEqual(self.command.appearancesadded, 8000)
+
+    def test_crawl_committee_in_thread(self):
+        committee = {'name': 'Finance', 'url': '/committees/Standing Committee on Finance'}
+        outcomes = [None, StopFetchingException('Reached Limit'), FetchError('status code: 500', status=500)]
+
+        with patch.object(self.command, 'processCommittee', side_effect=outcomes) as processCommittee:
+            with patch('za_hansard.management.commands.za_hansard_pmg_scraper.connection') as connection:
+                pool = ThreadPool(3)
+                try:
+                    results = pool.map(self.command.crawlCommitteeInThread, [('Standing', committee)] * 3)
+                finally:
+                    pool.close()
+                    pool.join()
+
+                # Stopping early and HTTP errors are dealt with for each
+                # committee, anything else is for the caller.
+                self.assertEqual(results, [{'name': 'Finance', 'url': committee['url'], 'type': 'Standing'}] * 3)
+                processCommittee.assert_called_with(
+                    'http://www.pmg.org.za/committees/Standing%20Committee%20on%20Finance', 'Finance')
+                self.assertEqual(self.command.numcommittees, 3)
+                self.assertIn('STOPPED Finance! Reached Limit\n', self.command.stderr.getvalue())
+                self.assertIn('HTTPERROR Finance', self.command.stderr.getvalue())
+
+                processCommittee.side_effect = ValueError('unexpected')
+                with self.assertRaises(ValueError):
+                    self.command.crawlCommitteeInThread(('Standing', committee))
+
+                # Each thread's database connection is closed, whatever happened.
+                self.assertEqual(connection.close.call_count, 4)
+
+    def report_pages(self):
+        """
+        Three pages of a committee's report listing, linked by their
+        'next' links, with five reports, and a list of the urls fetched.
+        """
+        def report(number):
+            return {
+                'date': '%02d May 2013' % number,
+                'meeting': 'Meeting %d' % number,
+                'url': '/report/%d' % number,
+                'image': '',
+                }
+
+        pages = {
+            'http://www.pmg.org.za/committees/Finance': {
+                'reports': [report(1), report(2), report(3)], 'next': '/committees/Finance?page=1'},
+            'http://www.pmg.org.za/committees/Finance?page=1': {
+                'reports': [report(4)], 'next': '/committees/Finance?page=2'},
+            'http://www.pmg.org.za/committees/Finance?page=2': {
+                'reports': [report(5)]},
+            }
+        fetched = []
+        def fetchReportsPage(url):
+            fetched.append(url)
+            return pages[url]
+
+        return (fetchReportsPage, fetched)
+
+    def test_report_rows(self):
+        (fetchReportsPage, fetched) = self.report_pages()
+        threads = threading.active_count()
+
+        with patch.object(self.command, 'fetchReportsPage', side_effect=fetchReportsPage):
+            rows = list(self.command.reportRows('http://www.pmg.org.za/committees/Finance'))
+            self.assertEqual([row['url'] for row in rows], ['/report/%d' % n for n in range(1, 6)])
+            self.assertEqual(fetched, [
+                'http://www.pmg.org.za/committees/Finance',
+                'http://www.pmg.org.za/committees/Finance?page=1',
+                'http://www.pmg.org.za/committees/Finance?page=2',
+                ])
+
+            # Closing the rows stops the fetching. The second page may
+            # already have been asked for, but not the third.
+            del fetched[:]
+            with closing(self.command.reportRows('http://www.pmg.org.za/committees/Finance')) as rows:
+                self.assertEqual(next(rows)['url'], '/report/1')
+            self.assertNotIn('http://www.pmg.org.za/committees/Finance?page=2', fetched)
+
+        # And the prefetching thread has gone.
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_process_reports_stops_fetching(self):
+        (fetchReportsPage, fetched) = self.report_pages()
+        threads = threading.active_count()
+
+        self.command.limit = 1
+        with patch.object(self.command, 'fetchReportsPage', side_effect=fetchReportsPage):
+            with patch.object(self.command, 'processReport') as process_report:
+                with self.assertRaises(StopFetchingException):
+                    self.command.processReports(
+                        'http://www.pmg.org.za/committees/Finance', 'Finance', '/committees/Finance')
+
+        self.assertEqual(
+            [call[0][1] for call in process_report.call_args_list],
+            ['http://www.pmg.org.za/report/1', 'http://www.pmg.org.za/report/2'])
+        self.assertNotIn('http://www.pmg.org.za/committees/Finance?page=2', fetched)
+        self.assertEqual(threading.active_count(), threads)
+
+    def test_report_processed_by_one_worker(self):
+        committee_url = 'http://www.pmg.org.za/committees/Finance'
+        meeting_url = 'http://www.pmg.org.za/report/20130508-joint-meeting'
+        page = {'reports': [{
+            'date': '08 May 2013',
+            'meeting': 'Joint meeting',
+            'url': '/report/20130508-joint-meeting',
+            'image': '',
+            }]}
+
+        claimed = []
+        def processReport(row, url, *args):
+            claimed.append(url in self.command.reports_in_progress)
+
+        with patch.object(self.command, 'fetchReportsPage', return_value=page):
+            with patch.object(self.command, 'processReport', side_effect=processReport) as process_report:
+                # Another worker is processing the report, so it's skipped,
+                # but isn't counted as seen.
+                self.command.reports_in_progress.add(meeting_url)
+                self.command.processReports(committee_url, 'Finance', '/committees/Finance')
+                self.assertEqual(process_report.call_count, 0)
+
+                # Otherwise it's claimed while it's processed.
+                self.command.reports_in_progress.clear()
+                self.command.processReports(committee_url, 'Finance', '/committees/Finance')
+                self.assertEqual(claimed, [True])
+                self.assertEqual(self.command.reports_in_progress, set())
+
+                # And the claim is given up if processing fails.
+                process_report.side_effect = FetchError('status code: 500', status=500)
+                with self.assertRaises(FetchError):
+                    self.command.processReports(committee_url, 'Finance', '/committees/Finance')
+                self.assertEqual(self.command.reports_in_progress, set())
+
+                # Once it has been processed it has been seen.
+                PMGCommitteeReport.objects.update(processed=True)
+                with self.assertRaises(StopFetchingException):
+                    self.command.processReports(committee_url, 'Finance', '/committees/Finance')
+                self.assertEqual(process_report.call_count, 2)
+
+        self.assertEqual(
+            list(PMGCommitteeReport.objects.values_list('meeting_url', flat=True)),
+            [meeting_url])
+
+    def test_process_report(self):
+        meeting_url = 'http://www.pmg.org.za/report/20130508-budget'
+        row = PMGCommitteeReport.objects.create(meeting_url=meeting_url, premium=False, processed=False)
+        PMGCommitteeAppearance.objects.create(
+            report=row, meeting_date=date(2013, 5, 8), committee_url='/committees/Finance',
+            committee='Finance', meeting='Budget', party='ANC', person='D Old',
+            meeting_url=meeting_url, text='Mr D Old (ANC) was scraped before.')
+
+        # Each person appears more than once, as a chair or in the minutes.
+        page = Mock(content="""<h1 class="title">Budget</h1>
+<div class="field-field-chairperson">Mr A Smith (ANC), Ms B Jones (DA) and Mr A Smith (ANC)</div>
+<div class="field-field-minutes"><div>
+Mr A Smith (ANC) opened the meeting.<br/>
+Mr C Brown (IFP) asked about the budget.<br/>
+Ms B Jones (DA) and Mr C Brown (IFP) discussed it.
+</div></div>""")
+
+        events = []
+        @contextmanager
+        def commit_on_success():
+            events.append('begin')
+            try:
+                yield
+            except:
+                events.append('rollback')
+                raise
+            events.append('commit')
+
+        create = PMGCommitteeAppearance.objects.bulk_create
+        def bulk_create(appearances):
+            # The old appearances should be gone by now.
+            events.append(list(
+                PMGCommitteeAppearance.objects.filter(report=row).values_list('person', flat=True)))
+            return create(appearances)
+
+        with patch.object(self.command, 'open_url_with_retries', return_value=page):
+            with patch.object(transaction, 'commit_on_success', commit_on_success):
+                with patch.object(PMGCommitteeAppearance.objects, 'bulk_create', side_effect=bulk_create):
+                    self.command.processReport(row, meeting_url, 'Finance', '/committees/Finance', '08 May 2013')
+
+                    self.assertEqual(events, ['begin', [], 'commit'])
+                    appearances = PMGCommitteeAppearance.objects.filter(report=row).order_by('person')
+                    self.assertEqual(
+                        [(appearance.person, appearance.text) for appearance in appearances],
+                        [('A Smith', 'Mr A Smith (ANC) chaired the meeting.'),
+                         ('B Jones', 'Ms B Jones (DA) chaired the meeting.'),
+                         ('C Brown', 'Mr C Brown (IFP) asked about the budget.')])
+                    self.assertEqual(self.command.appearancesadded, 3)
+                    self.assertTrue(PMGCommitteeReport.objects.get(pk=row.pk).processed)
+
+                    # A failure while writing them rolls the transaction back.
+                    del events[:]
+                    PMGCommitteeReport.objects.update(processed=False)
+                    create = Mock(side_effect=ValueError('bulk_create failed'))
+                    with self.assertRaises(ValueError):
+                        self.command.processReport(row, meeting_url, 'Finance', '/committees/Finance', '08 May 2013')
+                    self.assertEqual(events, ['begin', [], 'rollback'])
+                    self.assertFalse(PMGCommitteeReport.objects.get(pk=row.pk).processed)
+
+
+class PMGSaveJsonTests(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+        self.reports = []
+        for number in range(1, 4):
+            report = PMGCommitteeReport.objects.create(
+                premium=False,
+                processed=True,
+                meeting_url='http://www.pmg.org.za/report/%d' % number)
+            self.reports.append(report)
+
+            # The last report has no appearances.
+            for person in ['A Smith', 'C Jones'][:3 - number]:
+                PMGCommitteeAppearance.objects.create(
+                    report=report,
+                    meeting_date=date(2013, 5, number),
+                    committee_url='/committees/Finance',
+                    committee='Finance',
+                    meeting='Meeting %d' % number,
+                    party='ANC',
+                    person=person,
+                    meeting_url=report.meeting_url,
+                    text='%s spoke.' % person)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def filename(self, report):
+        return os.path.join(self.cache_dir, '%d.json' % report.id)
+
+    def manifest(self):
+        with open(os.path.join(self.cache_dir, 'manifest.json')) as manifest:
+            return json.load(manifest)
+
+    def save_json(self, command=None, **options):
+        command = command or PMGScraperCommand()
+        command.stdout = StringIO()
+        with override_settings(COMMITTEE_CACHE=self.cache_dir):
+            command.save_json(**options)
+        return command.stdout.getvalue()
+
+    def test_save_json(self):
+        (first, second, empty) = self.reports
+
+        self.assertEqual(self.save_json(), 'Wrote 2 reports (0 unchanged)\n')
+        self.assertEqual(sorted(self.manifest().keys()), sorted([str(first.id), str(second.id)]))
+        self.assertFalse(os.path.exists(self.filename(empty)))
+
+        with open(self.filename(first)) as report_file:
+            data = json.load(report_file)
+        self.assertEqual(data['title'], 'Meeting 1')
+        self.assertEqual(data['date'], '2013-05-01')
+        self.assertEqual(data['parent_section_titles'], ['Committee Minutes', 'Finance', '01 May 2013'])
+        self.assertEqual([speech['personname'] for speech in data['speeches']], ['A Smith', 'C Jones'])
+
+        # Nothing has changed, so nothing is written.
+        with open(self.filename(first), 'w') as report_file:
+            report_file.write('not rewritten')
+        self.assertEqual(self.save_json(), 'Wrote 0 reports (2 unchanged)\n')
+        self.assertEqual(open(self.filename(first)).read(), 'not rewritten')
+
+        # A changed appearance, or a missing file, is written again.
+        PMGCommitteeAppearance.objects.filter(report=first, person='C Jones').update(text='C Jones spoke again.')
+        os.remove(self.filename(second))
+        self.assertEqual(self.save_json(), 'Wrote 2 reports (0 unchanged)\n')
+        with open(self.filename(first)) as report_file:
+            self.assertEqual(json.load(report_file)['speeches'][1]['text'], 'C Jones spoke again.')
+        self.assertTrue(os.path.exists(self.filename(second)))
+
+    def test_interrupted(self):
+        (first, second, empty) = self.reports
+
+        command = PMGScraperCommand()
+        command.report_batch_size = 1
+
+        module = 'za_hansard.management.commands.za_hansard_pmg_scraper'
+        def failing_write_atomically(path, data):
+            if path == self.filename(second):
+                raise IOError('disk full')
+            write_atomically(path, data)
+
+        with patch(module + '.write_atomically', side_effect=failing_write_atomically):
+            self.assertRaises(IOError, self.save_json, command)
+
+        # The manifest was saved after the first batch.
+        self.assertEqual(self.manifest().keys(), [str(first.id)])
+
+        self.assertEqual(self.save_json(command), 'Wrote 1 reports (1 unchanged)\n')
+        self.assertEqual(sorted(self.manifest().keys()), sorted([str(first.id), str(second.id)]))
+
+    def test_workers(self):
+        self.save_json()
+        expected = dict(
+            (report.id, json.load(open(self.filename(report)))) for report in self.reports[:2])
+        for report in self.reports[:2]:
+            os.remove(self.filename(report))
+
+        # Closing the connection would lose the test's transaction.
+        with patch('za_hansard.pools.connection'):
+            self.assertEqual(self.save_json(workers=2), 'Wrote 2 reports (0 unchanged)\n')
+
+        for report in self.reports[:2]:
+            self.assertEqual(json.load(open(self.filename(report))), expected[report.id])
+
+class JsonLinesTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'test.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def written(self):
+        with open(self.filename) as written:
+            return written.read()
+
+    def test_round_trip(self):
+        objects = [
+            {'meeting_date': date(2013, 5, 8), 'person': u'A Smith'},
+            {'meeting_date': date(2013, 5, 9), 'person': u'C Jones', 'party': 'DA'},
+            ]
+        with JsonLinesWriter(self.filename) as writer:
+            for obj in objects:
+                writer.write(obj)
+
+        self.assertEqual(len(self.written().splitlines()), 2)
+        # Dates are written as strings.
+        self.assertEqual(list(read_json_lines(self.filename)), [
+            {'meeting_date': '2013-05-08', 'person': 'A Smith'},
+            {'meeting_date': '2013-05-09', 'person': 'C Jones', 'party': 'DA'},
+            ])
+
+    def test_partial_last_line(self):
+        with open(self.filename, 'w') as jsonl:
+            jsonl.write('{"a": 1}\n\n{"a": 2}\n{"a": 3, "b"')
+        self.assertEqual(list(read_json_lines(self.filename)), [{'a': 1}, {'a': 2}])
+
+    def test_corrupt_line(self):
+        with open(self.filename, 'w') as jsonl:
+            jsonl.write('{"a": 1}\n{"a": 2, "b"\n{"a": 3}\n')
+        lines = read_json_lines(self.filename)
+        self.assertEqual(next(lines), {'a': 1})
+        self.assertRaises(ValueError, next, lines)
+
+    def test_flushing(self):
+        with patch('za_hansard.datejson.time') as clock:
+            clock.time.return_value = 1000
+            writer = JsonLinesWriter(self.filename, flush_every=3, flush_interval=5)
+
+            writer.write({'a': 1})
+            writer.write({'a': 2})
+            self.assertEqual(self.written(), '')
+            writer.write({'a': 3})
+            self.assertEqual(len(self.written().splitlines()), 3)
+
+            # Or once flush_interval has passed.
+            writer.write({'a': 4})
+            self.assertEqual(len(self.written().splitlines()), 3)
+            clock.time.return_value = 1005
+            writer.write({'a': 5})
+            self.assertEqual(len(self.written().splitlines()), 5)
+
+            writer.write({'a': 6})
+            writer.close()
+            self.assertEqual(len(self.written().splitlines()), 6)
+
+    def test_threads(self):
+        with JsonLinesWriter(self.filename, flush_every=7) as writer:
+            def write(thread):
+                for i in range(500):
+                    writer.write({'thread': thread, 'i': i, 'padding': 'x' * 100})
+
+            threads = [threading.Thread(target=write, args=(n,)) for n in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        objects = list(read_json_lines(self.filename))
+        self.assertEqual(len(objects), 2000)
+        for n in range(4):
+            self.assertEqual(
+                [obj['i'] for obj in objects if obj['thread'] == n], range(500))
+
+
+class FakeImporter(object):
+    """Import each document as an empty section, failing on those in fail"""
+
+    def __init__(self, instance, fail=()):
+        self.instance = instance
+        self.fail = fail
+
+    def import_document(self, path):
+        section = Section.objects.create(title=path, instance=self.instance)
+        if path in self.fail:
+            raise ValueError('bad document %s' % path)
+        return section
+
+@skipUnless(connection.features.uses_savepoints, 'needs a database with savepoints')
+class SayitImportTests(TestCase):
+
+    def setUp(self):
+        (self.instance, _) = Instance.objects.get_or_create(label='default')
+        self.rows = [
+            PMGCommitteeReport.objects.create(
+                premium=False,
+                processed=True,
+                meeting_url='http://www.pmg.org.za/report/%d' % number)
+            for number in range(1, 5)
+            ]
+        self.documents = [
+            (row, 'report-%d' % number) for (number, row) in enumerate(self.rows, 1)]
+
+    def test_failed_document(self):
+        messages = []
+        importer = FakeImporter(self.instance, fail=['report-2'])
+
+        sections = import_documents(
+            importer, PMGCommitteeReport, self.documents, batch_size=3, log=messages.append)
+
+        self.assertEqual([section.title for section in sections], ['report-1', 'report-3', 'report-4'])
+        self.assertEqual(messages, ['failed to import %d: bad document report-2' % self.rows[1].id])
+
+        # The section the failed document had got as far as creating was
+        # rolled back, and only the imported rows are marked as imported.
+        self.assertEqual(
+            sorted(Section.objects.filter(instance=self.instance).values_list('title', flat=True)),
+            ['report-1', 'report-3', 'report-4'])
+
+        rows = PMGCommitteeReport.objects.filter(id__in=[row.id for row in self.rows]).order_by('id')
+        self.assertEqual(
+            [row.sayit_section_id for row in rows],
+            [sections[0].id, None, sections[1].id, sections[2].id])
+        self.assertEqual(
+            [row.last_sayit_import is not None for row in rows],
+            [True, False, True, True])
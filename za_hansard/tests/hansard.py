@@ -9,13 +9,25 @@ from django.test.utils import override_settings
 from django.core.exceptions import ImproperlyConfigured
 from django.conf import settings
 
-from za_hansard.models import Source
-
-from za_hansard.parse import ZAHansardParser
+from za_hansard.conversion_cache import cached_lines, cached_output, write_atomically
+from za_hansard.downloader import SourceDownloader, prefetch_sources
+from za_hansard.management.commands.za_hansard_check_for_new_sources import Command as CheckForNewSourcesCommand
+from za_hansard.management.commands.za_hansard_run_parsing import Command as RunParsingCommand
+from za_hansard.fetch import Fetcher, FetchError, HostScheduler
+from za_hansard.models import Source, SourceUrlCouldNotBeRetrieved
+
+from za_hansard.parse import AkomaNtosoWriter, ZAHansardParser
 from lxml import etree
 
+import BaseHTTPServer
+from cStringIO import StringIO
 import itertools
+import shutil
 import sys, os
+import tempfile
+import threading
+
+from mock import patch
 
 class ZAHansardParsingTests(TestCase):
 
@@ -146,6 +158,78 @@ class ZAHansardParsingTests(TestCase):
         subSections = mainSection.findall('{*}debateSection')
         self.assertEqual(len(subSections), 16)
 
+    def test_streamed_parse(self):
+        for docname in self.docnames:
+            filename = os.path.join( self._in_fixtures, '%s.%s' % (docname, 'doc') )
+            output = StringIO()
+            ZAHansardParser.parse_to_file(filename, output)
+
+            (xml, _) = self.xml.get(docname)
+            self.assertEqual(output.getvalue(), etree.tostring(xml), 'Streamed XML for %s differs' % docname)
+
+    def test_streamed_parse_releases_tree(self):
+        for docname in self.docnames:
+            filename = os.path.join( self._in_fixtures, '%s.%s' % (docname, 'doc') )
+
+            # Record how big the parser's tree is after each flush.
+            sizes = []
+            flush = AkomaNtosoWriter.flush
+            def recording_flush(writer):
+                flush(writer)
+                sizes.append(len(list(writer.parser.akomaNtoso.iter())))
+
+            with patch.object(AkomaNtosoWriter, 'flush', recording_flush):
+                ZAHansardParser.parse_to_file(filename, StringIO())
+
+            # Only the elements still being built are kept (a long speech
+            # stays whole until it's finished), never the whole document.
+            (xml, _) = self.xml.get(docname)
+            total = len(list(xml.iter()))
+            self.assertTrue(max(sizes) < total,
+                'Streamed parse of %s kept the whole tree' % docname)
+            self.assertTrue(sum(sizes) / len(sizes) < total / 2,
+                'Streamed parse of %s kept %d elements on average' % (docname, sum(sizes) / len(sizes)))
+
+class ZAHansardConversionCacheTests(TestCase):
+
+    tests_dir = os.path.dirname(os.path.abspath(__file__))
+    document_path = os.path.join(tests_dir, 'test_inputs', 'hansard', '502914_1.doc')
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_reparse_uses_cached_conversion(self):
+        with override_settings(HANSARD_CACHE=self.cache_dir):
+            lines = list(ZAHansardParser.antiword_lines(self.document_path))
+
+            # A second conversion shouldn't need antiword at all.
+            with patch('za_hansard.parse.subprocess.Popen', side_effect=AssertionError('antiword was run')):
+                cached_lines = list(ZAHansardParser.antiword_lines(self.document_path))
+
+        self.assertEqual(lines, cached_lines)
+        self.assertEqual(len(os.listdir(os.path.join(self.cache_dir, 'converted'))), 1)
+
+    def test_written_files_have_usual_permissions(self):
+        # Files written via a temporary file should be as readable as one
+        # just opened for writing, not only by their owner.
+        plain_path = os.path.join(self.cache_dir, 'plain')
+        open(plain_path, 'w').close()
+        mode = os.stat(plain_path).st_mode & 0777
+
+        write_atomically(os.path.join(self.cache_dir, 'written'), 'data')
+        list(cached_lines(self.cache_dir, ['converter'], 'lines', lambda: iter(['line\n'])))
+        cached_output(self.cache_dir, ['converter'], 'output', lambda: 'output')
+
+        paths = [os.path.join(self.cache_dir, 'written')]
+        for (directory, _, filenames) in os.walk(os.path.join(self.cache_dir, 'converted')):
+            paths.extend(os.path.join(directory, filename) for filename in filenames)
+        self.assertEqual(len(paths), 3)
+        for path in paths:
+            self.assertEqual(os.stat(path).st_mode & 0777, mode)
+
 class ZAHansardSayitLoadingTests(TestCase):
 
     tests_dir = os.path.dirname(os.path.abspath(__file__))
@@ -195,3 +279,440 @@ class ZAHansardSayitLoadingTests(TestCase):
         speech = sayit_section.descendant_speeches().all()[0]
         self.assertEqual(speech.tags.count(), 1)
         self.assertEqual(speech.tags.all()[0].name, 'hansard')
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Serve paths from the server's responses, a list of (status, body) or
+    (status, body, headers) for each. A request with validators matching
+    the response's ETag or Last-Modified header gets a 304 instead, with
+    only those headers.
+    """
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        self.server.request_headers.append(self.headers)
+        responses = self.server.responses.get(self.path, [(404, '')])
+        response = responses.pop(0) if len(responses) > 1 else responses[0]
+        (status, body, headers) = (response + ({},))[:3]
+
+        if status == 200 and (
+                (headers.get('ETag') and self.headers.get('If-None-Match') == headers['ETag']) or
+                (headers.get('Last-Modified') and self.headers.get('If-Modified-Since') == headers['Last-Modified'])):
+            (status, body) = (304, '')
+            headers = dict(
+                (name, value) for (name, value) in headers.items()
+                if name in ('ETag', 'Last-Modified'))
+
+        self.send_response(status)
+        for (name, value) in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class StubServerMixin(object):
+    """Serve the class's responses from a StubHandler server during each test"""
+
+    responses = {}
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = []
+        self.server.request_headers = []
+        self.server.responses = dict(
+            (path, list(responses)) for (path, responses) in self.responses.items())
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.cache_dir)
+
+    def url(self, path):
+        return 'http://127.0.0.1:%d%s' % (self.server.server_port, path)
+
+class ZAHansardDownloaderTests(StubServerMixin, TestCase):
+
+    responses = {
+        '/live/found': [(200, 'found document')],
+        '/live/found_with_suffix.doc': [(200, 'suffixed document')],
+        '/live/flaky': [(503, ''), (200, 'flaky document')],
+        }
+
+    def create_sources(self, urls):
+        for (number, url) in enumerate(urls):
+            Source.objects.create(
+                title           = 'HANSARD',
+                document_name   = url,
+                document_number = number,
+                date            = date(2013, 5, 8),
+                url             = url,
+                house           = 'National Assembly',
+                language        = 'English',
+            )
+
+    def test_prefetch_sources(self):
+        base_url = self.url('/live/')
+        self.create_sources(['found', 'found_with_suffix', 'flaky', 'missing'])
+
+        downloader = SourceDownloader(workers=2, fetcher=Fetcher(interval=0, backoff=0))
+        with override_settings(HANSARD_CACHE=self.cache_dir):
+            with patch('za_hansard.models.SOURCE_URL_BASE', base_url):
+                (downloaded, failed) = prefetch_sources(Source.objects.all(), downloader=downloader)
+
+                self.assertEqual((downloaded, failed), (3, 1))
+
+                for (name, content) in (('found', 'found document'),
+                                        ('found_with_suffix', 'suffixed document'),
+                                        ('flaky', 'flaky document')):
+                    source = Source.objects.get(document_name=name)
+                    self.assertFalse(source.is404)
+                    self.assertEqual(open(source.file()).read(), content)
+
+                self.assertEqual(Source.objects.get(document_name='found_with_suffix').url, 'found_with_suffix.doc')
+                self.assertTrue(Source.objects.get(document_name='missing').is404)
+
+                # Everything downloaded is now in the cache, so nothing is requested again.
+                del self.server.requests[:]
+                self.assertEqual(prefetch_sources(Source.objects.all(), downloader=downloader), (0, 1))
+                self.assertEqual(self.server.requests, ['/live/missing', '/live/missing.doc'])
+
+    def test_prefetched_suffix_survives_start_processing(self):
+        base_url = self.url('/live/')
+        self.create_sources(['found_with_suffix'])
+
+        # As in za_hansard_run_parsing's parse_in_parallel, the same source
+        # objects are prefetched and then processed (and saved).
+        sources = list(Source.objects.all())
+        downloader = SourceDownloader(workers=2, fetcher=Fetcher(interval=0, backoff=0))
+        command = RunParsingCommand()
+        command.stdout = StringIO()
+        command.stderr = StringIO()
+
+        with override_settings(HANSARD_CACHE=self.cache_dir):
+            with patch('za_hansard.models.SOURCE_URL_BASE', base_url):
+                self.assertEqual(prefetch_sources(sources, downloader=downloader), (1, 0))
+
+                del self.server.requests[:]
+                filename = command.start_processing(sources[0])
+
+        self.assertEqual(open(filename).read(), 'suffixed document')
+        self.assertEqual(self.server.requests, [])
+
+        source = Source.objects.get(document_name='found_with_suffix')
+        self.assertEqual(source.url, 'found_with_suffix.doc')
+        self.assertFalse(source.is404)
+        self.assertTrue(source.last_processing_attempt)
+
+class ZAHansardFetchTests(StubServerMixin, TestCase):
+
+    last_modified = 'Wed, 08 May 2013 10:00:00 GMT'
+    responses = {
+        '/etag': [(200, 'first version', {'ETag': '"1"'})],
+        '/last-modified': [(200, 'dated page', {'Last-Modified': last_modified})],
+        '/plain': [(200, 'plain page')],
+        '/utf-8': [(200, u'Nkosazana Dlamini-Zuma, Minist\xe9r'.encode('utf-8'),
+                    {'ETag': '"1"', 'Content-Type': 'text/html; charset=utf-8'})],
+        '/no-charset': [(200, u'Nkosazana Dlamini-Zuma, Minist\xe9r'.encode('utf-8'),
+                         {'ETag': '"1"', 'Content-Type': 'text/html'})],
+        '/flaky': [(503, ''), (200, 'flaky page')],
+        '/broken': [(500, '')],
+        }
+
+    def fetcher(self):
+        # Don't slow down after the errors served on purpose.
+        scheduler = HostScheduler(0)
+        scheduler.min_slow_interval = 0
+        return Fetcher(backoff=0, validator_dir=self.cache_dir, scheduler=scheduler)
+
+    def test_conditional_get(self):
+        fetcher = self.fetcher()
+
+        response = fetcher.get(self.url('/etag'), conditional=True)
+        self.assertEqual((response.status_code, response.content), (200, 'first version'))
+        self.assertEqual(self.server.request_headers[-1].get('If-None-Match'), None)
+
+        # The server answers the ETag with a 304, and the stored body is used.
+        response = fetcher.get(self.url('/etag'), conditional=True)
+        self.assertEqual((response.status_code, response.content), (200, 'first version'))
+        self.assertEqual(self.server.request_headers[-1].get('If-None-Match'), '"1"')
+
+        # A changed page is fetched, and its new validators used next time.
+        self.server.responses['/etag'] = [(200, 'second version', {'ETag': '"2"'})]
+        self.assertEqual(fetcher.get(self.url('/etag'), conditional=True).content, 'second version')
+        self.assertEqual(fetcher.get(self.url('/etag'), conditional=True).content, 'second version')
+        self.assertEqual(self.server.request_headers[-1].get('If-None-Match'), '"2"')
+
+        # The validators are stored on disk, so a new fetcher uses them too.
+        self.assertEqual(self.fetcher().get(self.url('/etag'), conditional=True).content, 'second version')
+        self.assertEqual(self.server.request_headers[-1].get('If-None-Match'), '"2"')
+
+        fetcher.get(self.url('/last-modified'), conditional=True)
+        response = fetcher.get(self.url('/last-modified'), conditional=True)
+        self.assertEqual((response.status_code, response.content), (200, 'dated page'))
+        self.assertEqual(self.server.request_headers[-1].get('If-Modified-Since'), self.last_modified)
+
+        # Without validators, or without conditional, the page is just fetched.
+        fetcher.get(self.url('/plain'), conditional=True)
+        fetcher.get(self.url('/plain'), conditional=True)
+        fetcher.get(self.url('/etag'))
+        for headers in self.server.request_headers[-3:]:
+            self.assertEqual(headers.get('If-None-Match'), None)
+            self.assertEqual(headers.get('If-Modified-Since'), None)
+
+    def test_conditional_get_encoding(self):
+        fetcher = self.fetcher()
+
+        # A page from a 304 is decoded with the original's charset, or
+        # ISO-8859-1 if it had none, just as it was when it was first
+        # fetched, and not by guessing from the body.
+        body = u'Nkosazana Dlamini-Zuma, Minist\xe9r'.encode('utf-8')
+        for (path, text) in (('/utf-8', body.decode('utf-8')),
+                             ('/no-charset', body.decode('iso-8859-1'))):
+            self.assertEqual(fetcher.get(self.url(path), conditional=True).text, text)
+            response = fetcher.get(self.url(path), conditional=True)
+            self.assertEqual(self.server.request_headers[-1].get('If-None-Match'), '"1"')
+            self.assertEqual(response.text, text)
+
+    def test_errors(self):
+        fetcher = self.fetcher()
+
+        with self.assertRaises(FetchError) as raised:
+            fetcher.get(self.url('/missing'))
+        self.assertEqual(raised.exception.status, 404)
+        # A 404 isn't worth retrying.
+        self.assertEqual(self.server.requests, ['/missing'])
+
+        del self.server.requests[:]
+        self.assertEqual(fetcher.get(self.url('/flaky')).content, 'flaky page')
+        self.assertEqual(self.server.requests, ['/flaky', '/flaky'])
+
+        del self.server.requests[:]
+        with self.assertRaises(FetchError) as raised:
+            fetcher.get(self.url('/broken'))
+        self.assertEqual(raised.exception.status, 500)
+        self.assertEqual(len(self.server.requests), fetcher.retries + 1)
+
+    def test_source_file_not_found(self):
+        source = Source.objects.create(
+            title           = 'HANSARD',
+            document_name   = 'missing',
+            document_number = 1,
+            date            = date(2013, 5, 8),
+            url             = 'missing',
+            house           = 'National Assembly',
+            language        = 'English',
+        )
+
+        with override_settings(HANSARD_CACHE=self.cache_dir):
+            with patch('za_hansard.models.SOURCE_URL_BASE', self.url('/live/')):
+                with self.assertRaises(SourceUrlCouldNotBeRetrieved) as raised:
+                    source.file()
+
+        self.assertEqual(str(raised.exception), 'status code: 404, url: missing')
+        self.assertEqual(self.server.requests, ['/live/missing', '/live/missing.doc'])
+        self.assertEqual(Source.objects.get(id=source.id).url, 'missing')
+
+class FakeClock(object):
+    """Stands in for the time module, with sleeps that pass instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        if seconds:
+            self.sleeps.append(seconds)
+            self.now += seconds
+
+class ZAHansardHostSchedulerTests(StubServerMixin, TestCase):
+
+    responses = {
+        '/page': [(200, 'page')],
+        '/flaky': [(503, ''), (502, ''), (200, 'flaky page')],
+        '/busy': [(429, '', {'Retry-After': '5'}), (200, 'busy page')],
+        }
+
+    def setUp(self):
+        super(ZAHansardHostSchedulerTests, self).setUp()
+        self.clock = FakeClock()
+        self.patcher = patch('za_hansard.fetch.time', self.clock)
+        self.patcher.start()
+
+        self.scheduler = HostScheduler(0.5)
+        self.fetcher = Fetcher(backoff=0, validator_dir=self.cache_dir, scheduler=self.scheduler)
+
+    def tearDown(self):
+        self.patcher.stop()
+        super(ZAHansardHostSchedulerTests, self).tearDown()
+
+    def test_interval(self):
+        for i in range(3):
+            self.fetcher.get(self.url('/page'))
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+
+        # A token builds up while no requests are made.
+        self.clock.now += 10
+        self.fetcher.get(self.url('/page'))
+        self.assertEqual(self.clock.sleeps, [0.5, 0.5])
+
+    def test_slows_down_after_server_errors(self):
+        state = self.scheduler.host(self.url('/flaky'))
+
+        self.assertEqual(self.fetcher.get(self.url('/flaky')).content, 'flaky page')
+        self.assertEqual(self.server.requests, ['/flaky'] * 3)
+        # The interval was doubled for each error (to at least
+        # min_slow_interval), and the retries waited for it.
+        self.assertEqual(self.clock.sleeps, [1, 3])
+        self.assertEqual(state.interval, 1.5)
+
+        # Successes bring it back down to the configured interval.
+        intervals = []
+        for i in range(5):
+            self.fetcher.get(self.url('/page'))
+            intervals.append(state.interval)
+        self.assertEqual(intervals, [1.125, 0.84375, 0.6328125, 0.5, 0.5])
+
+    def test_retry_after(self):
+        self.assertEqual(self.fetcher.get(self.url('/busy')).content, 'busy page')
+        self.assertEqual(self.server.requests, ['/busy'] * 2)
+        # The retry waited for as long as the 429's Retry-After asked.
+        self.assertEqual(self.clock.sleeps, [5])
+
+        # Other hosts aren't held up.
+        self.scheduler.acquire('http://example.com/')
+        self.scheduler.release('http://example.com/', 200)
+        self.assertEqual(self.clock.sleeps, [5])
+
+    def test_concurrency(self):
+        scheduler = HostScheduler(0, concurrency=2)
+        url = self.url('/page')
+        scheduler.acquire(url)
+        scheduler.acquire(url)
+
+        acquired = threading.Event()
+        def acquire():
+            scheduler.acquire(url)
+            acquired.set()
+        thread = threading.Thread(target=acquire)
+        thread.daemon = True
+        thread.start()
+
+        # A third request has to wait for one of the others to finish.
+        self.assertFalse(acquired.wait(0.2))
+        scheduler.release(url, 200)
+        self.assertTrue(acquired.wait(5))
+
+class ZAHansardCheckForNewSourcesTests(TestCase):
+
+    def setUp(self):
+        self.command = CheckForNewSourcesCommand()
+        self.command.stdout = StringIO()
+        self.command.stderr = StringIO()
+        self.command.historical_limit = date(2009, 4, 22)
+        self.command.known_sources = set()
+
+    def scraped_source(self, number, document_date=date(2013, 5, 8)):
+        return {
+            'document_name':   'doc%d' % number,
+            'document_number': str(number),
+            'defaults': {
+                'url':      'doc%d.doc' % number,
+                'title':    'HANSARD',
+                'language': 'English',
+                'house':    'National Assembly',
+                'date':     document_date,
+            }
+        }
+
+    def retrieve_sources(self, pages, **options):
+        """
+        Run retrieve_sources over a listing of pages of two sources each,
+        returning the sources and the offsets of the pages requested.
+        """
+        requested = []
+
+        def retrieve_page(start):
+            requested.append(start)
+            page = pages[start // 2]
+            return (start + 1, start + 2, len(pages) * 2, page)
+
+        options = dict({'check_all': False, 'limit': 0, 'workers': 1}, **options)
+        with patch.object(self.command, 'retrieve_page', side_effect=retrieve_page):
+            sources = self.command.retrieve_sources(0, options)
+        return (sources, sorted(requested))
+
+    def test_create_sources(self):
+        Source.objects.create(
+            title           = 'HANSARD',
+            document_name   = 'doc1',
+            document_number = 1,
+            date            = date(2013, 5, 8),
+            url             = 'doc1.doc',
+            house           = 'National Assembly',
+            language        = 'English',
+        )
+        self.command.known_sources = set(
+            Source.objects.values_list('document_name', 'document_number'))
+
+        sources = [self.scraped_source(n) for n in range(6)]
+        # Another name for a document number we already have.
+        clash = self.scraped_source(1)
+        clash['document_name'] = 'renamed'
+        sources.append(clash)
+        # Scraped twice, as when the listing shifts between pages.
+        sources.append(self.scraped_source(4))
+
+        with patch.object(Source.objects, 'bulk_create', wraps=Source.objects.bulk_create) as bulk_create:
+            self.assertEqual(self.command.create_sources(sources, 2), 5)
+
+        self.assertEqual([len(call[0][0]) for call in bulk_create.call_args_list], [2, 2, 1])
+        self.assertEqual(
+            sorted(Source.objects.values_list('document_number', flat=True)),
+            range(6))
+        self.assertIn('document number 1 already exists', self.command.stderr.getvalue())
+
+        # Nothing is created when the same sources are found again.
+        self.assertEqual(self.command.create_sources(sources, 2), 0)
+        self.assertEqual(Source.objects.count(), 6)
+
+    def test_retrieve_sources_stops_at_known_source(self):
+        pages = [[self.scraped_source(n), self.scraped_source(n + 1)] for n in range(0, 10, 2)]
+        self.command.known_sources.add(('doc5', 5))
+
+        (sources, requested) = self.retrieve_sources(pages)
+        self.assertEqual([s['document_number'] for s in sources], ['0', '1', '2', '3', '4'])
+        self.assertEqual(requested, [0, 2, 4])
+
+        # With more workers the next pages may already have been asked
+        # for, but the sources are still those before the known one.
+        (sources, requested) = self.retrieve_sources(pages, workers=3)
+        self.assertEqual([s['document_number'] for s in sources], ['0', '1', '2', '3', '4'])
+        self.assertEqual(requested[:3], [0, 2, 4])
+
+        # --check-all carries on to the end of the listing, in order.
+        (sources, requested) = self.retrieve_sources(pages, workers=3, check_all=True)
+        self.assertEqual([s['document_number'] for s in sources], [str(n) for n in range(10)])
+        self.assertEqual(requested, [0, 2, 4, 6, 8])
+
+    def test_retrieve_sources_stops_at_limits(self):
+        pages = [[self.scraped_source(n), self.scraped_source(n + 1)] for n in range(0, 10, 2)]
+        pages[3][1]['defaults']['date'] = date(2009, 1, 1)
+
+        (sources, requested) = self.retrieve_sources(pages)
+        self.assertEqual([s['document_number'] for s in sources], [str(n) for n in range(7)])
+        self.assertEqual(requested, [0, 2, 4, 6])
+
+        # --limit is the last offset to request.
+        (sources, requested) = self.retrieve_sources(pages, limit=4)
+        self.assertEqual([s['document_number'] for s in sources], ['0', '1', '2', '3'])
+        self.assertEqual(requested, [0, 2])
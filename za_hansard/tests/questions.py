@@ -1,21 +1,25 @@
 # -*- coding: utf-8 -*-
 
-from mock import patch
+from mock import Mock, patch
 import os
 import re
 import requests
 import shutil
+import subprocess
+import tempfile
 import datetime
 import json
 import lxml.etree
+from StringIO import StringIO
 from django.utils.unittest import skipUnless
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.template.defaultfilters import slugify
 
-from .. import question_scraper
-from ..management.commands.za_hansard_q_and_a_scraper import Command as QAScraperCommand
-from ..models import Question, QuestionPaper
+from .. import fetch, question_scraper
+from ..management.commands.za_hansard_q_and_a_scraper import Command as QAScraperCommand, download_answer, extract_answer_text
+from ..models import Answer, Question, QuestionPaper
 
 def sample_file(filename):
     tests_dir = os.path.dirname(os.path.abspath(__file__))
@@ -39,6 +43,133 @@ class ZAAnswerTests(TestCase):
         self.assertEqual(text, expected)
 
 
+class ZAAnswerProcessingTests(TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_download_answer(self):
+        filename = os.path.join(self.cache_dir, '1.doc')
+        job = (1, 'http://example.com/1.doc', filename)
+
+        with patch.object(fetch, 'get', return_value=Mock(content='answer document')) as get:
+            self.assertEqual(download_answer(job), (1, filename, None))
+            self.assertEqual(open(filename).read(), 'answer document')
+
+            # It's only downloaded once.
+            self.assertEqual(download_answer(job), (1, filename, None))
+            self.assertEqual(get.call_count, 1)
+
+        filename = os.path.join(self.cache_dir, '2.doc')
+        with patch.object(fetch, 'get', side_effect=fetch.FetchError('404 Not Found', status=404)):
+            (answer_id, returned_filename, error) = download_answer((2, 'http://example.com/2.doc', filename))
+
+        self.assertEqual((answer_id, returned_filename, error.status), (2, filename, 404))
+        self.assertFalse(os.path.exists(filename))
+
+    def test_extract_answer_text(self):
+        filename = sample_file('answer_1.doc')
+        expected = open(sample_file('answer_1_expected.txt')).read().decode('UTF-8')
+
+        self.assertEqual(extract_answer_text((1, filename)), (1, expected, False))
+
+        with patch.object(question_scraper, 'extract_answer_text_from_word_document',
+                          side_effect=subprocess.CalledProcessError(1, ['antiword', filename])):
+            self.assertEqual(extract_answer_text((1, filename)), (1, None, True))
+
+    def test_process_answers(self):
+        answers = [
+            Answer.objects.create(
+                document_name='RNW%d-130501' % number,
+                written_number=number,
+                date=datetime.date(2013, 5, 1),
+                year=2013,
+                house='N',
+                date_published=datetime.date(2013, 5, 1),
+                url='http://example.com/%d.doc' % number,
+                type='doc',
+                )
+            for number in (1, 2, 3)
+            ]
+
+        def fake_download_answer(job):
+            (answer_id, url, filename) = job
+            if url.endswith('/2.doc'):
+                return (answer_id, filename, fetch.FetchError('404 Not Found', status=404))
+            return (answer_id, filename, None)
+
+        def fake_extract_answer_text(job):
+            return (job[0], u'Answer %d' % job[0], False)
+
+        command = QAScraperCommand()
+        command.stdout = StringIO()
+        command.stderr = StringIO()
+
+        module = 'za_hansard.management.commands.za_hansard_q_and_a_scraper'
+        with override_settings(ANSWER_CACHE=self.cache_dir):
+            with patch(module + '.download_answer', new=fake_download_answer):
+                with patch(module + '.extract_answer_text', new=fake_extract_answer_text):
+                    with patch.object(command, 'process_answer_batch', wraps=command.process_answer_batch) as process_answer_batch:
+                        command.process_answers(workers=1, answer_batch_size=2)
+
+        self.assertEqual([len(call[0][0]) for call in process_answer_batch.call_args_list], [2, 1])
+
+        for (answer, processed_code) in zip(answers, (Answer.PROCESSED_OK, Answer.PROCESSED_HTTP_ERROR, Answer.PROCESSED_OK)):
+            answer = Answer.objects.get(id=answer.id)
+            self.assertEqual(answer.processed_code, processed_code)
+            if processed_code == Answer.PROCESSED_OK:
+                self.assertEqual(answer.text, u'Answer %d' % answer.id)
+
+        self.assertEqual(command.stderr.getvalue(), 'ERROR HTTPError while processing %d\n' % answers[1].id)
+
+
+class ZAAnswerMatchingTests(TestCase):
+
+    def create_answer(self, document_name, **numbers):
+        return Answer.objects.create(
+            document_name=document_name,
+            date=datetime.date(2013, 5, 1),
+            year=2013,
+            house='N',
+            date_published=datetime.date(2013, 5, 1),
+            **numbers)
+
+    def create_question(self, id_number, **numbers):
+        return Question.objects.create(
+            id_number=id_number,
+            identifier='NW%dE' % id_number,
+            house='N',
+            answer_type='W',
+            date=datetime.date(2013, 4, 1),
+            year=2013,
+            translated=False,
+            **numbers)
+
+    def test_match_answers(self):
+        written = self.create_question(1, written_number=10)
+        oral = self.create_question(2, oral_number=20)
+        president = self.create_question(3, president_number=30)
+        unanswered = self.create_question(4, written_number=40)
+
+        written_answer = self.create_answer('RNW10-130501', written_number=10)
+        oral_answer = self.create_answer('RNO20-130501', oral_number=20)
+        president_answer = self.create_answer('RNP30-130501', president_number=30)
+        self.create_answer('RNW50-130501', written_number=50)
+
+        QAScraperCommand().match_answers()
+
+        self.assertEqual(Question.objects.get(id=written.id).answer, written_answer)
+        self.assertEqual(Question.objects.get(id=oral.id).answer, oral_answer)
+        self.assertEqual(Question.objects.get(id=president.id).answer, president_answer)
+        self.assertEqual(Question.objects.get(id=unanswered.id).answer, None)
+
+        # Answers which have been matched are left alone in later runs.
+        with self.assertNumQueries(2):
+            QAScraperCommand().match_answers()
+
 
 class ZAIteratorBaseMixin(object):
 
@@ -253,6 +384,65 @@ class ZAQuestionParsing(TestCase):
 
             self.assertEqual(all_questions_as_data, expected_data)
 
+    def test_save_questions_skips_duplicates(self):
+        filename_root, source_url, house, date_published = self.test_data[1]
+        xmldata = open(sample_file(filename_root + ".xml")).read()
+
+        def parser(url=source_url):
+            return question_scraper.QuestionPaperParser(
+                name='TEST NAME',
+                date=date_published,
+                house=house,
+                language='TEST LANGUAGE',
+                url=url,
+                document_number=int(filename_root.split('_')[0]),
+                )
+
+        def question_numbers():
+            return sorted(Question.objects.values_list('written_number', flat=True))
+
+        with patch('sys.stdout', new_callable=StringIO):
+            parser().create_questions_from_xml(xmldata, source_url)
+            saved = question_numbers()
+            self.assertTrue(saved)
+
+            # Rerunning the same paper adds nothing.
+            parser().create_questions_from_xml(xmldata, source_url)
+            self.assertEqual(question_numbers(), saved)
+            self.assertEqual(QuestionPaper.objects.count(), 1)
+
+            # Nor does another paper with the same questions.
+            (question_paper, questions, expected_question_count) = parser('http://example.com/reissue.pdf').parse_questions_from_xml(xmldata)
+            question_paper.issue_number += 1
+            parser().save_questions(question_paper, questions, expected_question_count)
+            self.assertEqual(question_numbers(), saved)
+            self.assertEqual(QuestionPaper.objects.count(), 2)
+
+            # And questions repeated within a paper are only saved once.
+            Question.objects.all().delete()
+            (question_paper, questions, expected_question_count) = parser('http://example.com/repeated.pdf').parse_questions_from_xml(xmldata)
+            (_, repeated, _) = parser('http://example.com/repeated.pdf').parse_questions_from_xml(xmldata)
+            question_paper.issue_number += 2
+            parser().save_questions(question_paper, questions + repeated, expected_question_count)
+            self.assertEqual(question_numbers(), saved)
+
+    def test_remove_headers(self):
+        for filename_root, _, _, _ in self.test_data:
+            xmldata = open(sample_file(filename_root + ".xml")).read()
+
+            expected = lxml.etree.fromstring(xmldata)
+            counts = [question_scraper.remove_headers_from_page(page)
+                      for page in expected.iter('page')]
+
+            actual = lxml.etree.fromstring(xmldata)
+            stats = question_scraper.remove_headers(actual)
+
+            self.assertEqual(lxml.etree.tostring(actual), lxml.etree.tostring(expected), "Failed on {0}".format(filename_root))
+            self.assertEqual(stats['pages'], len(counts))
+            self.assertEqual(stats['pages_with_headers'], len([count for count in counts if count]))
+            self.assertEqual(stats['text_removed'], sum(counts))
+            self.assertEqual(stats['pages_by_position'] + stats['pages_by_search'], stats['pages_with_headers'])
+            self.assertTrue(stats['pages_by_position'] > 0)
     
     def test_page_header_removal(self):
         tests = [
@@ -376,3 +566,151 @@ class ZAQuestionParsing(TestCase):
 
 # 517147_1
 
+
+class ZAQuestionScrapingTests(TestCase):
+
+    papers = dict(
+        (filename_root, (source_url, house, date_published))
+        for (filename_root, source_url, house, date_published)
+        in ZAQuestionParsing.test_data)
+
+    def detail(self, filename_root, url=None, language='English'):
+        (source_url, house, date_published) = self.papers.get(
+            filename_root, self.papers['559662_1'])
+        return {
+            'name': 'TEST NAME',
+            'language': language,
+            'url': url or source_url,
+            'house': house,
+            'date': date_published,
+            'type': 'pdf',
+            'document_number': int(filename_root.split('_')[0]) if filename_root in self.papers else 1,
+            }
+
+    def scrape_questions_pipelined(self, details):
+        """
+        Run the pipelined question scraper over details, with each paper's
+        'PDF' being the name of its XML sample file, returning what it
+        wrote to stdout.
+        """
+        def download_question_pdf(url):
+            return url.rsplit('/', 1)[1][:-len('.pdf')]
+
+        def pdftoxml(pdfdata):
+            if pdfdata == 'empty':
+                return ''
+            return open(sample_file(pdfdata + '.xml')).read()
+
+        command = QAScraperCommand()
+        with patch.object(question_scraper, 'QuestionDetailIterator', return_value=iter(details)):
+            with patch.object(question_scraper.QuestionPaperParser, 'download_question_pdf', side_effect=download_question_pdf):
+                with patch.object(question_scraper, 'pdftoxml', side_effect=pdftoxml):
+                    # Closing the connection would lose the test's transaction.
+                    with patch('za_hansard.pools.connection'):
+                        with patch('sys.stdout', new_callable=StringIO) as stdout:
+                            command.stdout = stdout
+                            command.scrape_questions(workers=2, limit=0, fetch_to_limit=False)
+        return stdout.getvalue()
+
+    def test_scrape_questions_pipelined(self):
+        details = [
+            self.detail('559662_1'),
+            self.detail('559662_1', url='http://example.com/559662_1-afrikaans.pdf', language='Afrikaans'),
+            self.detail('empty', url='http://example.com/empty.pdf'),
+            self.detail('517147_1'),
+            # Listed again, perhaps before the first one was saved.
+            self.detail('559662_1'),
+            self.detail('548302_1'),
+            ]
+
+        output = self.scrape_questions_pipelined(details)
+
+        # The output for each paper, whichever process it came from, is
+        # written in listing order.
+        lines = [line for line in output.splitlines() if re.match(r' *\d+ ', line)]
+        self.assertEqual(len(lines), 5)
+        self.assertTrue(lines[0].startswith('    1 {0} PROCESSING found '.format(details[0]['url'])))
+        self.assertEqual(lines[1], '    2 {0} SKIPPING presumably not English'.format(details[1]['url']))
+        self.assertEqual(lines[2], '    3 {0} PROCESSING SKIPPING - Got no XML data'.format(details[2]['url']))
+        self.assertTrue(lines[3].startswith('    4 {0} PROCESSING found '.format(details[3]['url'])))
+        self.assertEqual(lines[4], '    5 {0} SKIPPING as file already handled'.format(details[4]['url']))
+        self.assertIn("Stopping as '--fetch-to-limit' not given\n", output)
+        self.assertTrue(output.endswith('Processed 5 documents (0 errors)\n'))
+
+        self.assertEqual(
+            sorted(QuestionPaper.objects.values_list('source_url', flat=True)),
+            sorted([details[0]['url'], details[3]['url']]))
+
+    def test_scrape_questions_pipelined_retries_unsaved_paper(self):
+        details = [self.detail('559662_1'), self.detail('559662_1')]
+
+        save_questions = question_scraper.QuestionPaperParser.save_questions.im_func
+        calls = []
+        def failing_save_questions(parser, *parsed):
+            calls.append(parser.kwargs['url'])
+            if len(calls) == 1:
+                raise Exception('database trouble')
+            return save_questions(parser, *parsed)
+
+        with patch.object(question_scraper.QuestionPaperParser, 'save_questions', new=failing_save_questions):
+            output = self.scrape_questions_pipelined(details)
+
+        # The paper which failed to save wasn't counted as seen, so the
+        # second listing of it was saved.
+        self.assertEqual(len(calls), 2)
+        self.assertIn('ERROR handling {0}: database trouble\n'.format(details[0]['url']), output)
+        self.assertTrue(output.endswith('Processed 2 documents (1 errors)\n'))
+        self.assertEqual(QuestionPaper.objects.get().source_url, details[0]['url'])
+
+    def test_save_question_paper(self):
+        xmldata = open(sample_file('559662_1.xml')).read()
+
+        qp_parser = question_scraper.QuestionPaperParser(**self.detail('559662_1'))
+        qp_parser.create_questions_from_xml(xmldata, qp_parser.kwargs['url'])
+        question_paper = QuestionPaper.objects.get()
+        question_count = Question.objects.count()
+        self.assertTrue(question_count > 0)
+
+        # The same paper from another URL isn't saved again, nor are its
+        # questions.
+        reprint = question_scraper.QuestionPaperParser(
+            **self.detail('559662_1', url='http://example.com/559662_1-reprint.pdf'))
+        with patch('sys.stdout', new_callable=StringIO) as stdout:
+            parsed = reprint.parse_questions_from_xml(xmldata)
+            self.assertEqual(reprint.save_question_paper(parsed[0]), None)
+            reprint.save_questions(*parsed)
+
+        self.assertIn('BAILING OUT: Question Paper http://example.com/559662_1-reprint.pdf too similar to', stdout.getvalue())
+        self.assertEqual(QuestionPaper.objects.get(), question_paper)
+        self.assertEqual(Question.objects.count(), question_count)
+
+    def test_pdftoxml_failure(self):
+        def popen(args, **kwargs):
+            kwargs['stderr'].write("Syntax Error: Couldn't find trailer dictionary\n")
+            process = Mock()
+            process.stdout = StringIO('')
+            process.wait.return_value = process.returncode = 1
+            return process
+
+        message = "pdftohtml exited with status 1: Syntax Error: Couldn't find trailer dictionary"
+        detail = self.detail('559662_1')
+
+        with override_settings(CONVERSION_CACHE=False):
+            with patch.object(question_scraper.subprocess, 'Popen', side_effect=popen):
+                with self.assertRaises(question_scraper.PdfConversionError) as raised:
+                    question_scraper.pdftoxml('not a pdf')
+                self.assertEqual(str(raised.exception), message)
+
+                # The paper is skipped, rather than the error being left
+                # for the caller.
+                qp_parser = question_scraper.QuestionPaperParser(**detail)
+                with patch.object(qp_parser, 'get_question_pdf_from_url', return_value='not a pdf'):
+                    with patch('sys.stdout', new_callable=StringIO) as stdout:
+                        qp_parser.get_questions()
+                self.assertEqual(stdout.getvalue(), ' SKIPPING - {0}\n'.format(message))
+
+                self.assertEqual(
+                    question_scraper.parse_question_paper(detail, 'not a pdf'),
+                    (' SKIPPING - {0}\n'.format(message), None))
+
+        self.assertFalse(QuestionPaper.objects.exists())